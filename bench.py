@@ -0,0 +1,430 @@
+"""
+    Benchmarks for build.py. Run from the root of the repo, e.g.:
+
+        python3 bench.py merge --addons 10000
+        python3 bench.py build --addons 50 --files 20
+        python3 bench.py build --addons 50 --bump
+        python3 bench.py suite
+        python3 bench.py submodule --jobs 3 --from-git
+        python3 bench.py memory --size-gib 3
+
+    Results are printed as JSON so they can be compared between commits.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import zipfile
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from xml.etree import ElementTree
+
+import build
+
+
+def _addon_element(addon_id, version):
+    addon = ElementTree.Element("addon", id=addon_id, name=addon_id, version=version)
+    addon.text = "\n    "
+    ext = ElementTree.SubElement(addon, "extension", point="xbmc.addon.metadata")
+    ext.tail = "\n"
+    summary = ElementTree.SubElement(ext, "summary")
+    summary.text = "Synthetic addon {}".format(addon_id)
+    return addon
+
+
+def _legacy_merge(addons_xml_path, new_entries):
+    # The XPath based merge that build.py used before the indexed merge, for comparison
+    addons_xml = ElementTree.parse(addons_xml_path)
+    addons_root = addons_xml.getroot()
+    for id, addon_root in new_entries.items():
+        addon_entry = addons_root.find("addon[@id='{}']".format(id))
+        if addon_entry is not None and addon_entry.get('version') != addon_root.get('version'):
+            index = addons_root.findall('addon').index(addon_entry)
+            addons_root.remove(addon_entry)
+            addons_root.insert(index, addon_root)
+        elif addon_entry is None:
+            addons_root.append(addon_root)
+    addons_root[:] = sorted(addons_root, key=lambda addon: addon.get('id'))
+    with open(os.devnull, "wb") as f:
+        addons_xml.write(f, encoding="utf-8", xml_declaration=True)
+
+
+def bench_merge(addons, legacy=False):
+    """
+    Merges addons synthetic addon entries into an existing addons.xml of the same size,
+    with 10% of the addons bumped and 1% new.
+    """
+    result = {"benchmark": "merge", "addons": addons}
+    with tempfile.TemporaryDirectory() as tmp:
+        addons_xml_path = os.path.join(tmp, "addons.xml")
+        ids = ["plugin.bench.{:06d}".format(i) for i in range(addons)]
+        with open(addons_xml_path, "wb") as f:
+            build._write_addons_xml(f, (_addon_element(id, "1.0.0") for id in ids))
+
+        new_entries = {}
+        for i, id in enumerate(ids):
+            if i % 10 == 0:
+                new_entries[id] = _addon_element(id, "1.0.1")
+        for i in range(max(1, addons // 100)):
+            id = "plugin.bench.new.{:06d}".format(i)
+            new_entries[id] = _addon_element(id, "1.0.0")
+
+        def merge():
+            versions, is_sorted = build._read_addon_versions(addons_xml_path)
+            with open(os.path.join(tmp, "addons.xml.new"), "wb") as f:
+                entries = build._iter_addon_entries(addons_xml_path)
+                build._write_addons_xml(f, build._merge_addon_entries(entries, new_entries, versions))
+
+        start = time.perf_counter()
+        merge()
+        result["merge_write_s"] = time.perf_counter() - start
+
+        # Measured in a second run, tracing allocations slows the merge down considerably
+        tracemalloc.start()
+        merge()
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        if legacy:
+            start = time.perf_counter()
+            _legacy_merge(addons_xml_path, new_entries)
+            result["legacy_merge_write_s"] = time.perf_counter() - start
+    return result
+
+
+def generate_repo(path, addons, files=10, incompressible=0.3, depth=3, file_size=4096, seed=1):
+    """
+    Writes a synthetic repo/ folder to path: the repository addon of this repo plus
+    addons addons with files files each below resources/, nested depth folders deep.
+    A share of incompressible of those files is random data, the rest is Python-like
+    text. Sizes vary around file_size, and the same arguments give the same tree.
+    """
+    rnd = random.Random(seed)
+    repo_path = os.path.join(path, "repo")
+    shutil.copytree(
+        os.path.join(os.path.dirname(os.path.abspath(build.__file__)), "repo", "repository.verkurkie"),
+        os.path.join(repo_path, "repository.verkurkie"),
+    )
+    words = ["addon", "item", "url", "self", "return", "listitem", "xbmc", "path", "None", "def"]
+
+    for i in range(addons):
+        addon_id = "plugin.bench.{:05d}".format(i)
+        addon_folder = os.path.join(repo_path, addon_id)
+        os.makedirs(os.path.join(addon_folder, "resources"))
+        python = "3.0.0" if i % 2 else "2.26.0"
+        with open(os.path.join(addon_folder, "addon.xml"), "w") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<addon id="{addon_id}" name="Bench {i}" version="1.0.0" provider-name="bench">\n'
+                '    <requires>\n'
+                f'        <import addon="xbmc.python" version="{python}"/>\n'
+                '    </requires>\n'
+                '    <extension point="xbmc.python.pluginsource" library="main.py"/>\n'
+                '    <extension point="xbmc.addon.metadata">\n'
+                f'        <summary>Synthetic addon {addon_id}</summary>\n'
+                '        <assets>\n'
+                '            <icon>icon.png</icon>\n'
+                '            <fanart>fanart.jpg</fanart>\n'
+                '        </assets>\n'
+                '    </extension>\n'
+                '</addon>\n'
+            )
+        with open(os.path.join(addon_folder, "main.py"), "w") as f:
+            f.write("import xbmc\n\nxbmc.log('{}')\n".format(addon_id))
+        with open(os.path.join(addon_folder, "changelog.txt"), "w") as f:
+            f.write("v1.0.0\n- Initial release\n")
+        for art, size in [("icon.png", 8 * 1024), ("fanart.jpg", 32 * 1024)]:
+            with open(os.path.join(addon_folder, art), "wb") as f:
+                f.write(rnd.randbytes(size))
+
+        for n in range(files):
+            # Spread the files over the levels of a resources/lib/level1/.../levelN tree
+            levels = ["lib"] + ["level{}".format(level) for level in range(1, n % (depth + 1))]
+            folder = os.path.join(addon_folder, "resources", *levels)
+            os.makedirs(folder, exist_ok=True)
+            size = rnd.randint(file_size // 2, file_size * 3 // 2)
+            if rnd.random() < incompressible:
+                with open(os.path.join(folder, "data{}.bin".format(n)), "wb") as f:
+                    f.write(rnd.randbytes(size))
+            else:
+                text = []
+                length = 0
+                while length < size:
+                    line = "    {} = {}({})\n".format(*rnd.choices(words, k=3))
+                    text.append(line)
+                    length += len(line)
+                with open(os.path.join(folder, "module{}.py".format(n)), "w") as f:
+                    f.write("".join(text))
+    return ["plugin.bench.{:05d}".format(i) for i in range(addons)]
+
+
+def _bump_addon(path, addon_id):
+    # Raises the version of an addon and changes one of its files, like a new release would
+    addon_folder = os.path.join(path, "repo", addon_id)
+    addon_xml_path = os.path.join(addon_folder, "addon.xml")
+    with open(addon_xml_path) as f:
+        addon_xml = f.read()
+    with open(addon_xml_path, "w") as f:
+        f.write(addon_xml.replace('version="1.0.0" provider-name', 'version="1.0.1" provider-name', 1))
+    with open(os.path.join(addon_folder, "changelog.txt"), "a") as f:
+        f.write("v1.0.1\n- Bumped\n")
+
+
+def _run_build(jobs):
+    """
+    Runs a build in the current folder the way build.py's __main__ does, as a Scheduler
+    running schedule_build(), and returns the wall time of each of its phases (which
+    overlap) and of the whole build. _copy_meta_files runs while packaging; its time is
+    only collected when packaging in this process (jobs=1).
+    """
+    meta_time = [0.0]
+    copy_meta_files = build.Generator._copy_meta_files
+
+    def timed_copy_meta_files(self, *args):
+        start = time.perf_counter()
+        try:
+            return copy_meta_files(self, *args)
+        finally:
+            meta_time[0] += time.perf_counter() - start
+
+    build.Generator._copy_meta_files = timed_copy_meta_files
+    build.PROFILER.reset()
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            generator = build.Generator(jobs=jobs, manifest=build.Manifest(), build=False)
+            scheduler = build.Scheduler(workers=generator.jobs + 4)
+            build.schedule_build(scheduler, generator, jobs=jobs)
+            scheduler.run()
+            total = time.perf_counter() - start
+    finally:
+        build.Generator._copy_meta_files = copy_meta_files
+        spans = build.PROFILER.spans
+        build.PROFILER.reset(enabled=False)
+
+    phases = {span["name"] + "_s": span["wall"] for span in spans if span["category"] == "phase"}
+    packaging = [span for span in spans if span["category"] == "package"]
+    if packaging:
+        phases["package_s"] = max(span["start"] + span["wall"] for span in packaging) - min(
+            span["start"] for span in packaging
+        )
+    phases["copy_meta_files_s"] = meta_time[0] if generator.jobs == 1 else None
+    phases["total_s"] = total
+    return phases
+
+
+def _run_build_job(path, jobs):
+    # Runs _run_build() in path in a process of its own, and adds the peak RSS of that process
+    os.chdir(path)
+    phases = _run_build(jobs)
+    phases["peak_rss_bytes"] = build._peak_memory()
+    return phases
+
+
+def _run_build_isolated(path, jobs):
+    """
+    Runs _run_build() in path in a new process, so the peak RSS it reports is that of the
+    build (and the interpreter), not of everything the benchmark did before. The peak is
+    measured over the whole build: its phases overlap in one process. Worker processes
+    (jobs > 1) are not children of that process, so their memory is not included.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_build_job, path, jobs).result()
+
+
+def bench_build(addons, files=10, incompressible=0.3, depth=3, file_size=4096, jobs=1, bump=False):
+    """
+    Builds a synthetic repository from scratch and times each phase, and measures the
+    peak RSS of the build, see _run_build_isolated(). With bump=True the first build is
+    not measured; instead one addon gets a new version and the incremental rebuild is.
+    """
+    result = {
+        "benchmark": "build",
+        "scenario": "bump" if bump else "full",
+        "addons": addons,
+        "files": files,
+        "incompressible": incompressible,
+        "depth": depth,
+        "file_size": file_size,
+        "jobs": jobs,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        addon_ids = generate_repo(tmp, addons, files, incompressible, depth, file_size)
+        if bump:
+            _run_build_isolated(tmp, jobs)
+            if addon_ids:
+                _bump_addon(tmp, addon_ids[len(addon_ids) // 2])
+        phases = _run_build_isolated(tmp, jobs)
+    result["peak_rss_bytes"] = phases.pop("peak_rss_bytes")
+    result["phases"] = phases
+    return result
+
+
+def _git(cwd, *args):
+    # Runs git with an identity, and with file:// submodules allowed (git >= 2.38.1 refuses them)
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", "-c", "protocol.file.allow=always"]
+        + list(args),
+        cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def bench_submodule(addons=20, jobs=3, from_git=True, timeout=300):
+    """
+    Runs build.py like CI does on a synthetic repository in which one addon is a submodule
+    that is not at its recorded commit, so its update runs alongside the packaging of the
+    other addons. Raises RuntimeError if the build fails or doesn't finish within timeout
+    seconds, or the submodule addon was not built at its recorded version.
+    """
+    result = {"benchmark": "submodule", "addons": addons, "jobs": jobs, "from_git": from_git}
+    with tempfile.TemporaryDirectory() as tmp:
+        work = os.path.join(tmp, "work")
+        generate_repo(work, addons)
+        shutil.copy(os.path.abspath(build.__file__), work)
+
+        # The submodule's own repository, with the version the parent records on top
+        source = os.path.join(tmp, "submodule")
+        addon_id = "plugin.bench.submodule"
+        os.makedirs(source)
+        _git(source, "init", "-q")
+        for version in ["1.0.0", "1.0.1"]:
+            with open(os.path.join(source, "addon.xml"), "w") as f:
+                f.write(
+                    '<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<addon id="{addon_id}" name="Submodule" version="{version}" provider-name="bench">\n'
+                    '    <extension point="xbmc.addon.metadata"><summary>Submodule</summary></extension>\n'
+                    '</addon>\n'
+                )
+            with open(os.path.join(source, "main.py"), "w") as f:
+                f.write("# {}\n".format(version))
+            _git(source, "add", "-A")
+            _git(source, "commit", "-q", "-m", version)
+
+        _git(work, "init", "-q")
+        _git(work, "add", "-A")
+        _git(work, "commit", "-q", "-m", "synthetic")
+        _git(work, "submodule", "add", "-q", source, os.path.join("repo", addon_id))
+        _git(work, "commit", "-q", "-m", "submodule")
+        _git(os.path.join(work, "repo", addon_id), "checkout", "-q", "HEAD~1")
+
+        env = dict(os.environ, GIT_CONFIG_COUNT="1", GIT_CONFIG_KEY_0="protocol.file.allow", GIT_CONFIG_VALUE_0="always")
+        command = [sys.executable, "build.py", "--jobs", str(jobs)] + (["--from-git"] if from_git else [])
+        start = time.perf_counter()
+        try:
+            build_process = subprocess.run(
+                command, cwd=work, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            raise RuntimeError("{} did not finish within {}s".format(" ".join(command), timeout))
+        result["total_s"] = time.perf_counter() - start
+        if build_process.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(" ".join(command), build_process.stderr))
+        zip_path = os.path.join(work, "zips", addon_id, "{}-1.0.1.zip".format(addon_id))
+        if not os.path.isfile(zip_path):
+            raise RuntimeError("{} was not built after its submodule update".format(zip_path))
+    return result
+
+
+def bench_memory(size=3 * 1024 ** 3, limit=200 * 1024 ** 2, jobs=1):
+    """
+    Packages an addon with a sparse file of size bytes by running build.py, and checks that
+    the file is streamed into the zip rather than read whole: raises RuntimeError if the
+    peak RSS of the build exceeds limit bytes, or the file is missing from the zip.
+    """
+    result = {"benchmark": "memory", "file_size": size, "limit_bytes": limit, "jobs": jobs}
+    with tempfile.TemporaryDirectory() as tmp:
+        addon_id = generate_repo(tmp, 1, files=1)[0]
+        with open(os.path.join(tmp, "repo", addon_id, "resources", "large.bin"), "wb") as f:
+            f.truncate(size)
+        shutil.copy(os.path.abspath(build.__file__), tmp)
+
+        # build.py is the only child process waited for, so the children's peak RSS is its own
+        command = [sys.executable, "build.py", "--jobs", str(jobs)]
+        start = time.perf_counter()
+        build_process = subprocess.run(command, cwd=tmp, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+        result["total_s"] = time.perf_counter() - start
+        if build_process.returncode != 0:
+            raise RuntimeError("{} failed:\n{}".format(" ".join(command), build_process.stderr))
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        result["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+
+        zip_path = os.path.join(tmp, "zips", addon_id, "{}-1.0.0.zip".format(addon_id))
+        with zipfile.ZipFile(zip_path) as zipf:
+            member = zipf.getinfo("{}/resources/large.bin".format(addon_id))
+        if member.file_size != size:
+            raise RuntimeError("large.bin is {} bytes in the zip, not {}".format(member.file_size, size))
+    if result["peak_rss_bytes"] > limit:
+        raise RuntimeError(
+            "Peak RSS of {} MiB exceeds the limit of {} MiB".format(
+                result["peak_rss_bytes"] // (1024 * 1024), limit // (1024 * 1024)
+            )
+        )
+    return result
+
+
+def bench_suite(jobs=1):
+    """
+    Runs the standard build scenarios: 1, 50 and 5000 addons from scratch, and a single
+    addon bumped in a repository of 50 addons.
+    """
+    results = [bench_build(addons, jobs=jobs) for addons in [1, 50, 5000]]
+    results.append(bench_build(50, jobs=jobs, bump=True))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for build.py.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    merge_parser = subparsers.add_parser("merge", help="merge of addon entries into addons.xml")
+    merge_parser.add_argument("--addons", type=int, default=10000, help="number of synthetic addons (default: 10000)")
+    merge_parser.add_argument("--legacy", action="store_true", help="also time the old quadratic merge")
+    build_parser = subparsers.add_parser("build", help="phases of a build of a synthetic repository")
+    build_parser.add_argument("--addons", type=int, default=50, help="number of synthetic addons (default: 50)")
+    build_parser.add_argument("--files", type=int, default=10, help="files per addon below resources/ (default: 10)")
+    build_parser.add_argument(
+        "--incompressible", type=float, default=0.3, help="share of files with random content (default: 0.3)"
+    )
+    build_parser.add_argument("--depth", type=int, default=3, help="folder depth below resources/lib/ (default: 3)")
+    build_parser.add_argument("--file-size", type=int, default=4096, help="average file size in bytes (default: 4096)")
+    build_parser.add_argument("--bump", action="store_true", help="time the rebuild after bumping a single addon")
+    suite_parser = subparsers.add_parser("suite", help="build scenarios with 1, 50 and 5000 addons and a single bump")
+    submodule_parser = subparsers.add_parser(
+        "submodule", help="build.py run on a synthetic repository with an outdated submodule; fails if it hangs"
+    )
+    submodule_parser.add_argument("--addons", type=int, default=20, help="number of synthetic addons (default: 20)")
+    submodule_parser.add_argument("--from-git", action="store_true", help="build with --from-git")
+    submodule_parser.add_argument(
+        "--timeout", type=int, default=300, help="seconds after which the build counts as hung (default: 300)"
+    )
+    memory_parser = subparsers.add_parser(
+        "memory", help="build.py run on a sparse multi-GB file; fails if its peak RSS exceeds the limit"
+    )
+    memory_parser.add_argument("--size-gib", type=float, default=3, help="size of the sparse file in GiB (default: 3)")
+    memory_parser.add_argument("--limit-mib", type=int, default=200, help="peak RSS limit in MiB (default: 200)")
+    for sub in [build_parser, suite_parser, submodule_parser, memory_parser]:
+        sub.add_argument("-j", "--jobs", type=int, default=1, help="worker processes of the build (default: 1)")
+    args = parser.parse_args()
+
+    if args.benchmark == "merge":
+        result = bench_merge(args.addons, legacy=args.legacy)
+    elif args.benchmark == "build":
+        result = bench_build(
+            args.addons, args.files, args.incompressible, args.depth, args.file_size, args.jobs, args.bump
+        )
+    elif args.benchmark == "memory":
+        result = bench_memory(int(args.size_gib * 1024 ** 3), args.limit_mib * 1024 * 1024, args.jobs)
+    elif args.benchmark == "submodule":
+        result = bench_submodule(args.addons, args.jobs, args.from_git, args.timeout)
+    else:
+        result = bench_suite(args.jobs)
+    json.dump(result, sys.stdout, indent=2)
+    print()
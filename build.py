@@ -6,16 +6,71 @@
 
 import os
 import sys
-import glob
+import gzip
+import argparse
 import subprocess
 import shutil
 import hashlib
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
+import select
+import struct
 import zipfile
+import threading
 import time
+import zlib
+from stat import S_ISDIR
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager, nullcontext, redirect_stdout
 from xml.etree import ElementTree
 
 SCRIPT_VERSION = 2
+# Bump whenever the zip or meta file output changes, so stale cache entries are not reused
+CACHE_VERSION = 3
+CACHE_PATH = ".build-cache"
+ZIP_CHUNK_SIZE = 1024 * 1024
+# Zip members up to this size are read whole and deflated in the thread pool of build_zip(),
+# larger ones are streamed in order on the main thread
+PARALLEL_MEMBER_SIZE = 8 * 1024 * 1024
+# Header of a compressed member in the member cache: compression method, CRC and size
+MEMBER_HEADER = struct.Struct("<HIQ")
+INDEX_FILES = ("index.html", "index.json")
+# Watch mode: changes are collected until none came in for WATCH_DEBOUNCE seconds
+WATCH_DEBOUNCE = 0.2
+WATCH_POLL_INTERVAL = 0.5
+# Every published file (path, size, mtime, sha256) of the last build, and how it differed from the one before
+PUBLISHED_MANIFEST = os.path.join(CACHE_PATH, "published.json")
+PUBLISHED_DIFF = os.path.join(CACHE_PATH, "published-diff.json")
+METADATA_CACHE = os.path.join(CACHE_PATH, "metadata.json")
+# How files that already exist elsewhere on disk are placed, see _place_file()
+LINK_MODES = ["auto", "reflink", "hardlink", "copy"]
+FICLONE = 0x40049409  # Linux ioctl that shares the blocks of a file (btrfs, XFS, ...)
+# Zip members with these extensions are already compressed and are stored as-is
+STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".mp3", ".mp4", ".m4a", ".mkv", ".ogg", ".flac",
+    ".zip", ".gz", ".bz2", ".xz", ".7z",
+}
+# "auto" also stores members whose first bytes do not compress below PROBE_RATIO
+COMPRESSION_POLICIES = ["auto", "extension", "deflate"]
+PROBE_SIZE = 64 * 1024
+PROBE_RATIO = 0.95
+# Images losslessly optimised with --optimise-images, and the PNG chunks they lose
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_STRIPPED_CHUNKS = {b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+# Output trees: "repo" is the zips folder itself, the others are built in zips/<version>/
 KODI_VERSIONS = ["krypton", "leia", "matrix", "repo"]
+# Range of xbmc.python versions each Kodi version runs (oldest compatible, provided)
+KODI_PYTHON_ABI = {
+    "krypton": ("2.1.0", "2.25.0"),
+    "leia": ("2.1.0", "2.26.0"),
+    "matrix": ("3.0.0", "3.0.0"),
+}
 IGNORE = [
     "docs",
     "build.py",
@@ -69,32 +124,42 @@ def color_text(text, color):
     )
 
 
-def cleanup():
+def cleanup(force=False):
     # Cleanup the root folder:
-    # pe.cfg, *.bak, *.zip, /zips
+    # pe.cfg, *.bak, *.zip, and /zips when forced (otherwise the build updates it in place)
     print("Cleaning up the root folder...")
     for file in os.listdir("."):
         if file.endswith(".bak") or file == "pe.cfg" or file.endswith(".zip"):
             print("- removing file: {}".format(color_text(file, 'red')))
             os.remove(file)
-    if os.path.exists("zips"):
+    if force and os.path.exists("zips"):
         print("- removing folder: {}".format(color_text("zips", 'red')))
         shutil.rmtree("zips")
 
 
-def copy_repo_zip():
+def copy_repo_zip(manifest=None, link_mode="auto"):
     # Copy the newly created repository ZIP file from zips/repository.verkurkie/ folder to the root folder
     # Note: the ZIP file name is unknown because it may have a new version number! Copy has to be for [repository.verkurkie*.zip]!
 
-    # Use glob to find the file
-    zip_file = glob.glob("zips/repository.verkurkie/*.zip")[0]
+    if manifest is None:
+        manifest = Manifest()
+        manifest.scan("zips/repository.verkurkie")
 
-    if not zip_file:
+    # Find the file in the manifest
+    zip_files = [
+        os.path.join("zips/repository.verkurkie", f)
+        for f in manifest.listdir("zips/repository.verkurkie")
+        if f.endswith(".zip")
+    ]
+
+    if not zip_files:
         raise RuntimeError("No repository ZIP file found in zips/repository.verkurkie")
-    
+    zip_file = zip_files[0]
+
     # Copy the file
     print("Copying repository ZIP file to the root folder...")
-    shutil.copy(zip_file, ".")
+    _place_file(zip_file, os.path.basename(zip_file), link_mode)
+    manifest.record(os.path.basename(zip_file))
     print("- copied file: {}".format(color_text(zip_file, 'green')))
 
 
@@ -132,22 +197,45 @@ def user_confirm(msg, default="yes"):
     return user_input.lower() in answers_true
 
 
-def check_submodules():
-    # Check if there are committed/uncommitted or untracked changes in submodule(s)
-    print("Updating & checking submodules...")
-    subprocess.run(["git", "submodule", "update", "--init", "--recursive"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    status = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True).stdout
-    
-    # Get the list of submodules dynamically
-    submodules = subprocess.run(["git", "submodule", "--quiet", "foreach", "echo $sm_path"], 
-                               capture_output=True, text=True).stdout.splitlines()
+def check_submodules(jobs=1, update=True):
+    """
+    Checks the submodules for local changes, and asks whether to continue if there are
+    any. Returns the submodules that are not at the commit recorded in the repo, after
+    updating them unless update is False, e.g. to update them with update_submodules()
+    while the rest of the build goes on.
+    """
+    print("Checking submodules...")
+    # Lines are "<state><commit> <path> (<describe>)", with state " " when the checked out commit
+    # matches the one recorded in the repo, "-" when not initialized, "+" when it differs and "U"
+    # on merge conflicts. Outside of a git work tree there is no output.
+    status = subprocess.run(["git", "submodule", "status", "--recursive"], capture_output=True, text=True).stdout
+    submodules = []
+    outdated = []
+    for line in status.splitlines():
+        path = line[1:].split(" ", 1)[1]
+        if path.endswith(")") and " (" in path:
+            path = path.rsplit(" (", 1)[0]
+        submodules.append(path)
+        if line[0] != " ":
+            outdated.append(path)
+    if not submodules:
+        return []
+
+    # Limited to the submodules, so the rest of the work tree is not scanned. In the v2 format
+    # a submodule is "1 <XY> S<c><m><u> ... <path>"; only modified (m) or untracked (u) content
+    # is a local change, a new commit (c) is what an update checks out anyway.
+    status = subprocess.run(
+        ["git", "status", "--porcelain=v2", "--"] + submodules, capture_output=True, text=True
+    ).stdout
 
     dirty_submodules = []
     for line in status.splitlines():
-        # Line format: XY path (e.g., ' M repo/script.iptv.xtream-to-m3u')
-        path = line[3:].strip()
-        if any(path.startswith(sm) for sm in submodules):
-            dirty_submodules.append(path)
+        fields = line.split(" ", 8 if line.startswith("1 ") else 9)
+        if fields[0] not in ("1", "2") or not fields[2].startswith("S"):
+            continue
+        if "M" in fields[2][2:] or "U" in fields[2][2:]:
+            # Renames ("2") end with "<path>\t<original path>"
+            dirty_submodules.append(fields[-1].split("\t")[0])
 
     if dirty_submodules:
         print(color_text("Warning: The following submodule(s) have changes:", "red"))
@@ -163,164 +251,427 @@ def check_submodules():
             print(color_text(cancel_msg, "yellow"))
             sys.exit(0)
 
+    if update and outdated:
+        update_submodules(outdated, jobs=jobs)
+    return outdated
 
-def generate_indices():
+
+def update_submodules(submodules, jobs=1):
+    # Check out the recorded commit of the given submodules, fetching them in parallel
+    print("Updating submodules: {}".format(", ".join(color_text(path, 'green') for path in submodules)))
+    jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+    subprocess.run(
+        ["git", "submodule", "update", "--init", "--recursive", "--jobs", str(jobs), "--"] + submodules,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def generate_indices(manifest=None, folders=None, addons=None, done=None):
     """
-    Generates index.html files for the root and recursively for the zips folder.
+    Generates index.html and index.json files for the root and recursively for the zips folder.
+    Listings come from the build manifest; without one the zips folder is scanned once.
+    A folder's index is only rewritten when its listing changed since the last build.
+    With folders, only the indices of those folders, the folders below and above them are
+    checked, e.g. after a single addon was rebuilt. The version of the repository addon
+    comes from addons, the AddonMetadata of the Generator; without it the addon.xml is read.
+    done maps the zip folders whose indices generate_folder_indices() already generated to
+    what it returned; they and the folders below them are not walked again.
     """
     release_path = '.'
     addon_path = os.path.join(release_path, "repo")
     zips_path = os.path.join(release_path, "zips")
-    addons_xml_path = os.path.join(zips_path, "addons.xml")
-    md5_path = os.path.join(zips_path, "addons.xml.md5")
+
+    if manifest is None:
+        manifest = Manifest()
+        manifest.scan(zips_path)
+    for name in INDEX_FILES:
+        if not manifest.exists(os.path.join(release_path, name)):
+            manifest.scan(os.path.join(release_path, name))
+
+    # A folder is listed with the mtime of the newest file below it, not its own mtime, which
+    # changes whenever an entry is created (e.g. on every fresh checkout) even if the content didn't
+    folder_mtimes = {}
 
     # 1. Recursive zips/ generation
-    for root, dirs, files in os.walk(zips_path):
-        # Sort for deterministic output
-        dirs.sort()
-        files.sort()
+    done = done or {}
+    updated, unchanged = _generate_zip_indices(manifest, zips_path, folder_mtimes, folders, done)
+    for done_updated, done_unchanged, _ in done.values():
+        updated += done_updated
+        unchanged += done_unchanged
 
-        # Skip writing to the directory if it doesn't exist (sanity check)
-        if not os.path.exists(root):
-            continue
+    # 2. Generate ./index.html (Root)
+    # We need to find the version of repository.verkurkie to link it correctly
+    try:
+        repo_xml_path = os.path.join(addon_path, "repository.verkurkie", "addon.xml")
+        if addons is not None:
+            repository = addons.get("repository.verkurkie")
+        elif os.path.exists(repo_xml_path):
+            repository = AddonMetadata.read(repo_xml_path)
+        else:
+            repository = None
+        if repository is not None:
+            version = repository.version
 
-        # Build list of items
-        items = []
-        
-        # Add parent directory link
-        rel_path = os.path.relpath(root, zips_path)
-        items.append({
-            "name": "../", 
-            "href": "../", 
-            "date": "-", 
-            "size": "-"
-        })
-
-        # Add directories
-        for d in dirs:
-            path = os.path.join(root, d)
-            stats = os.stat(path)
-            mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(stats.st_mtime))
-            items.append({
-                "name": f"{d}/", 
-                "href": f"{d}/", 
-                "date": mtime, 
-                "size": "-"
-            })
+            zip_file = f"repository.verkurkie-{version}.zip"
+
+            root_entries = []
+            for name, is_dir in [("zips", True), (zip_file, False)]:
+                stats = manifest.get(os.path.join(release_path, name))
+                entry = {"name": name, "type": "dir" if is_dir else "file"}
+                if stats is not None:
+                    entry["mtime"] = folder_mtimes.get(os.path.normpath(zips_path), stats.mtime) if is_dir else stats.mtime
+                    if not is_dir:
+                        entry["size"] = stats.size
+                root_entries.append(entry)
+
+            if _update_index(release_path, "Index of /", root_entries, manifest, parent_link=False):
+                updated += 1
+            else:
+                unchanged += 1
+    except Exception as e:
+        print(f"Error generating root index: {e}")
+
+    print("Index pages: {} updated, {} unchanged".format(updated, unchanged))
+
+
+def scan_trees(manifest, skip=()):
+    # Scans repo/ and zips/ into the manifest, except the addon folders in skip, e.g. while
+    # their submodule is updated
+    if skip:
+        for name in os.listdir("repo"):
+            if name not in skip:
+                manifest.scan(os.path.join("repo", name))
+    else:
+        manifest.scan("repo")
+    manifest.scan("zips")
 
-        # Add files (excluding index.html)
+
+def index_zip_folders(manifest, published, generator, folder, done):
+    """
+    Generates the index files of the zip folders of an addon once it is packaged, after
+    giving their files the mtime of the previous build back where the content is the same.
+    What generate_folder_indices() returns for each zip folder is added to done, for
+    generate_indices().
+    """
+    for zip_folder in generator.zip_folders(folder):
+        if manifest.isdir(zip_folder):
+            restore_published_mtimes(manifest, published, top=zip_folder)
+            done[zip_folder] = generate_folder_indices(manifest, zip_folder)
+
+
+def generate_folder_indices(manifest, folder):
+    """
+    Generates the index files of a folder in zips/ and the folders below it, e.g. as soon
+    as the zip folder of an addon is final. Returns how many were updated and left
+    unchanged, and the mtime the folder is listed with (None for an empty one). Those of
+    the folders above it are left to generate_indices().
+    """
+    folder_mtimes = {}
+    updated, unchanged = _generate_zip_indices(manifest, folder, folder_mtimes)
+    return updated, unchanged, folder_mtimes.get(os.path.normpath(folder))
+
+
+def _generate_zip_indices(manifest, top, folder_mtimes, folders=None, done=None):
+    """
+    Generates the index files of top and the folders below it, deepest folders first so the
+    folders listed by a page are final, and records the mtime each folder is listed with in
+    folder_mtimes. Folders not related to any of folders are skipped, and the folders in done
+    (see generate_indices()) and below them are not walked. Returns how many index pages
+    were updated and left unchanged.
+    """
+    updated = unchanged = 0
+    done = {os.path.normpath(folder): result[2] for folder, result in (done or {}).items()}
+    walk = []
+    for root, dirs, files in manifest.walk(top):
+        walk.append((root, list(dirs), files))
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) not in done]
+    for root, dirs, files in reversed(walk):
+        rel_path = os.path.relpath(root, "zips")
+
+        entries = []
+        for d in dirs:
+            path = os.path.normpath(os.path.join(root, d))
+            if done.get(path) is not None:
+                mtime = done[path]
+            else:
+                mtime = folder_mtimes[path] if path in folder_mtimes else manifest.get(path).mtime
+            entries.append({"name": d, "type": "dir", "mtime": mtime})
+
+        # Add files (excluding the index files themselves)
         for f in files:
-            if f == "index.html":
+            if f in INDEX_FILES:
                 continue
-            path = os.path.join(root, f)
-            stats = os.stat(path)
-            mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(stats.st_mtime))
-            size = str(stats.st_size)
-            items.append({
-                "name": f, 
-                "href": f, 
-                "date": mtime, 
-                "size": size
-            })
+            stats = manifest.get(os.path.join(root, f))
+            entries.append({"name": f, "type": "file", "size": stats.size, "mtime": stats.mtime})
+        if entries:
+            folder_mtimes[os.path.normpath(root)] = max(entry["mtime"] for entry in entries)
+        if folders is not None and not any(_is_related_path(root, folder) for folder in folders):
+            continue
 
         # Determine title
         if rel_path == ".":
             title = "Index of /zips/"
         else:
             title = f"Index of /zips/{rel_path}/"
-        
-        # Write index.html
-        index_path = os.path.join(root, "index.html")
-        with open(index_path, "w") as f:
-            f.write(_create_index_content(items, title=title))
-        print(f"Updated index: {color_text(index_path, 'yellow')}")
 
-    # 2. Generate ./index.html (Root)
-    # We need to find the version of repository.verkurkie to link it correctly
+        if _update_index(root, title, entries, manifest):
+            updated += 1
+        else:
+            unchanged += 1
+    return updated, unchanged
+
+
+def _is_related_path(path, other):
+    # True if path is other, or a folder above or below it
+    path, other = os.path.normpath(path), os.path.normpath(other)
+    return path == other or (path + os.sep).startswith(other + os.sep) or (other + os.sep).startswith(path + os.sep)
+
+
+def _published_files(manifest, top=None, skip=()):
+    # The root index and repository zip, and everything in zips/ (or only below top) except
+    # the folders in skip
+    if top is None:
+        for name in manifest.listdir("."):
+            if (name in INDEX_FILES or name.endswith(".zip")) and manifest.isfile(name):
+                yield name
+    skip = {os.path.normpath(folder) for folder in skip}
+    for root, dirs, files in manifest.walk(top or "zips"):
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) not in skip]
+        for file in files:
+            yield os.path.join(root, file)
+
+
+def _load_published_manifest():
     try:
-        repo_xml_path = os.path.join(addon_path, "repository.verkurkie", "addon.xml")
-        if os.path.exists(repo_xml_path):
-            repo_xml = ElementTree.parse(repo_xml_path)
-            version = repo_xml.getroot().get('version')
-            
-            root_index_path = "index.html"
-            zip_file = f"repository.verkurkie-{version}.zip"
-            
-            # Helper to get stats for root items
-            def get_root_item(name, href, is_dir=False):
-                if is_dir:
-                    path = href.rstrip('/') # remove trailing slash for stat
-                    if os.path.exists(path):
-                        stats = os.stat(path)
-                        mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(stats.st_mtime))
-                        return {"name": name, "href": href, "date": mtime, "size": "-"}
-                elif os.path.exists(name):
-                    stats = os.stat(name)
-                    mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(stats.st_mtime))
-                    size = str(stats.st_size)
-                    return {"name": name, "href": href, "date": mtime, "size": size}
-                return {"name": name, "href": href, "date": "-", "size": "-"}
-
-            root_items = [
-                get_root_item("zips/", "zips/", is_dir=True),
-                get_root_item(zip_file, zip_file),
-            ]
-            
-            with open(root_index_path, "w") as f:
-                f.write(_create_index_content(root_items, title="Index of /"))
-            print("Successfully updated {}".format(color_text(root_index_path, 'yellow')))
-    except Exception as e:
-        print(f"Error generating root index: {e}")
+        with open(PUBLISHED_MANIFEST) as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
 
-def _create_index_content(items, title="Index"):
-    template = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
-<html>
-<head>
-<title>{title}</title>
-</head>
-<body>
-<h1>{title}</h1>
-<pre>
-{header}
-<hr>
-{rows}
-<hr>
-</pre>
-</body>
-</html>"""
+def restore_published_mtimes(manifest, previous, indices=False, top=None, skip=()):
+    """
+    Gives published files with the same content as in the previous build their previous
+    mtime back, so they look untouched to a deploy step or mirror that compares size and
+    mtime. Without indices only the other files are handled: they have to be restored
+    before generate_indices() lists them, the index files after. With top, only the files
+    in that folder of zips/ and below it are handled, and none in the folders in skip.
+    """
+    restored = 0
+    for path in _published_files(manifest, top, skip):
+        if (os.path.basename(path) in INDEX_FILES) != indices:
+            continue
+        old = previous.get(path.replace(os.sep, "/"))
+        entry = manifest.get(path)
+        if old is None or old["size"] != entry.size or old["mtime_ns"] == entry.mtime_ns:
+            continue
+        # A hard link to a file restored earlier in the loop is restored (to the same mtime) again
+        if manifest.sha256(path) == old["sha256"]:
+            os.utime(path, ns=(os.stat(path).st_atime_ns, old["mtime_ns"]))
+            manifest.record(path)
+            restored += 1
+    return restored
+
+
+def write_published_manifest(manifest, previous):
+    """
+    Writes the path, size, mtime and sha256 of every published file to PUBLISHED_MANIFEST,
+    and the files that were added, changed or removed since the previous build to
+    PUBLISHED_DIFF. Hashes are taken from the previous manifest when size and mtime match,
+    and sizes and mtimes from the manifest of the build.
+    """
+    files = {}
+    for path in _published_files(manifest):
+        key = path.replace(os.sep, "/")
+        entry = manifest.get(path)
+        old = previous.get(key)
+        if old is not None and (old["size"], old["mtime_ns"]) == (entry.size, entry.mtime_ns):
+            files[key] = old
+        else:
+            files[key] = {"size": entry.size, "mtime_ns": entry.mtime_ns, "sha256": manifest.sha256(path)}
+
+    diff = {
+        "added": sorted(path for path in files if path not in previous),
+        "changed": sorted(
+            path for path in files if path in previous and files[path]["sha256"] != previous[path]["sha256"]
+        ),
+        "removed": sorted(path for path in previous if path not in files),
+    }
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    for path, data in [(PUBLISHED_MANIFEST, {"files": files}), (PUBLISHED_DIFF, diff)]:
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    print(
+        "Published files: {} added, {} changed, {} removed, {} unchanged (see {})".format(
+            len(diff["added"]),
+            len(diff["changed"]),
+            len(diff["removed"]),
+            len(files) - len(diff["added"]) - len(diff["changed"]),
+            color_text(PUBLISHED_DIFF, 'yellow'),
+        )
+    )
+    return diff
+
+
+def _update_index(folder, title, entries, manifest, parent_link=True):
+    """
+    Writes the index.html and index.json of a folder, unless the listing (names, sizes,
+    mtimes and hashes) is the same as in the existing index.json. File hashes are taken
+    from the existing index.json when size and mtime did not change, else from the
+    manifest (see Manifest.sha256()).
+    Returns True if the index was written.
+    """
+    html_path = os.path.join(folder, "index.html")
+    json_path = os.path.join(folder, "index.json")
+
+    previous = {}
+    if manifest.isfile(json_path):
+        try:
+            with open(json_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+    previous_entries = {e.get("name"): e for e in previous.get("entries", [])}
+
+    for entry in entries:
+        if entry["type"] != "file" or "mtime" not in entry:
+            continue
+        old = previous_entries.get(entry["name"], {})
+        if old.get("size") == entry["size"] and old.get("mtime") == entry["mtime"] and "sha256" in old:
+            entry["sha256"] = old["sha256"]
+        else:
+            entry["sha256"] = manifest.sha256(os.path.join(folder, entry["name"]))
+
+    index = {"title": title, "entries": entries}
+    if index == previous and manifest.isfile(html_path):
+        return False
+
+    items = []
+    if parent_link:
+        # Add parent directory link
+        items.append({"name": "../", "href": "../", "date": "-", "size": "-"})
+    for entry in entries:
+        is_dir = entry["type"] == "dir"
+        name = entry["name"] + "/" if is_dir else entry["name"]
+        if "mtime" in entry:
+            date = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry["mtime"]))
+        else:
+            date = "-"
+        size = str(entry["size"]) if "size" in entry else "-"
+        items.append({"name": name, "href": name, "date": date, "size": size})
+
+    with open(html_path, "w") as f:
+        _write_index_content(f, items, title=title)
+    with open(json_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    manifest.record(html_path)
+    manifest.record(json_path)
+    print(f"Updated index: {color_text(html_path, 'yellow')}")
+    return True
+
+
+def _place_file(src, dst, mode="auto"):
+    """
+    Places a copy of src at dst, atomically through a temporary file and a rename, and
+    keeps the mtime of src. Depending on the mode the copy shares the data of src:
+    - reflink: a reflink (FICLONE) or an in-kernel copy_file_range, else a regular copy
+    - hardlink: a hard link, else a regular copy
+    - auto: a true reflink, else a hard link, else a regular copy
+    - copy: always a regular copy
+    Returns the method that was used.
+    """
+    methods = {
+        "auto": ["clone", "hardlink", "copy"],
+        "reflink": ["reflink", "copy"],
+        "hardlink": ["hardlink", "copy"],
+        "copy": ["copy"],
+    }[mode]
+    folder, name = os.path.split(dst)
+    tmp = os.path.join(folder, ".{}.{}.tmp".format(name, os.getpid()))
+    for method in methods:
+        try:
+            if method in ("clone", "reflink"):
+                _reflink(src, tmp, in_kernel_copy=method == "reflink")
+            elif method == "hardlink":
+                os.link(src, tmp)
+            else:
+                shutil.copy2(src, tmp)
+            os.replace(tmp, dst)
+            # Renaming a hard link onto another link of the same file is a no-op
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            return method
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if method == "copy":
+                raise
+
+
+def _reflink(src, dst, in_kernel_copy=True):
+    """
+    Clones src into dst without copying the data through user space. Raises OSError
+    if FICLONE is not supported for these files, and copy_file_range is not either
+    or in_kernel_copy is False.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            import fcntl
+
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (ImportError, OSError):
+            if not in_kernel_copy or not hasattr(os, "copy_file_range"):
+                raise OSError("reflinks are not supported")
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+    shutil.copystat(src, dst)
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_index_content(f, items, title="Index"):
+    """
+    Writes an index page row by row.
+    """
     # Calculate max length for Name column (min 50)
     max_len = 50
     for item in items:
         if len(item["name"]) > max_len:
             max_len = len(item["name"])
-    
+
     # Add a little buffer
     name_width = max_len + 5
     date_width = 20
     size_width = 10
 
+    f.write(
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">\n'
+        f"<html>\n<head>\n<title>{title}</title>\n</head>\n<body>\n<h1>{title}</h1>\n<pre>\n"
+    )
+
     # Header
-    header = f'{"Name".ljust(name_width)}{"Last modified".ljust(date_width)}{"Size".rjust(size_width)}'
+    f.write(f'{"Name".ljust(name_width)}{"Last modified".ljust(date_width)}{"Size".rjust(size_width)}\n<hr>\n')
 
     # Rows
-    rows = ""
     for item in items:
-        name_cell = f'<a href="{item["href"]}">{item["name"]}</a>'.ljust(name_width + (len(f'<a href="{item["href"]}">{item["name"]}</a>') - len(item["name"])))
-        # Logic above for ljust on HTML string is tricky because len() counts tags.
-        # Easier way: constructs the plain text padded line, then replace Name with Link.
-        
-        line_fmt = f'{{name:<{name_width}}}{{date:<{date_width}}}{{size:>{size_width}}}'
-        # But we can't easily reuse it because we need to inject the <a> tag around the name *before* padding? 
-        # No, if we pad the LINK it messes up alignment relative to visible text.
-        # We must pad the visible text, but output the link.
-        # Standard way: <a href>Name</a> + spaces
-        
+        # We must pad the visible text, but output the link: <a href>Name</a> + spaces
         spaces = " " * (name_width - len(item["name"]))
         link = f'<a href="{item["href"]}">{item["name"]}</a>'
-        row = f'{link}{spaces}{item["date"].ljust(date_width)}{item["size"].rjust(size_width)}'
-        rows += row + "\n"
-    
-    return template.format(title=title, rows=rows, header=header)
+        f.write(f'{link}{spaces}{item["date"].ljust(date_width)}{item["size"].rjust(size_width)}\n')
+
+    f.write("\n<hr>\n</pre>\n</body>\n</html>")
 
 
 def _save_file(data, file):
@@ -336,44 +687,1296 @@ def _save_file(data, file):
             )
         )
 
-class Generator:
+
+def _io_counters():
+    # Bytes read and written by the calling thread so far, (None, None) where that isn't known
+    try:
+        with open("/proc/thread-self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_memory():
+    # Peak resident set size of this process in bytes, None where that isn't known
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
     """
-    Generates a new addons.xml file from each addons addon.xml file
-    and a new addons.xml.md5 hash file. Must be run from the root of
-    the checked-out repo.
+    Records spans for --profile: the wall time, CPU time and bytes read and written of
+    each span, and the peak memory (ru_maxrss) the process reached by the time it ended,
+    which is the peak of the process's whole lifetime so far, not of the span alone.
+    Disabled (and nearly free) by default. Spans recorded by worker processes are handed
+    back with their results and merged in.
+
+    Spans run at the same time on many threads (tasks, zip members), so the CPU time and
+    bytes read and written are those of the thread that ran the span. Work it hands to
+    other threads is counted in their spans, e.g. members compressed in a thread pool.
     """
 
     def __init__(self):
-        self.release_path = ''
-        self.addon_path = os.path.join(self.release_path, "repo")
-        self.zips_path = os.path.join(self.release_path, "zips")
-        addons_xml_path = os.path.join(self.zips_path, "addons.xml")
-        md5_path = os.path.join(self.zips_path, "addons.xml.md5")
+        self.enabled = False
+        self.spans = []
 
-        if not os.path.exists(self.zips_path):
-            os.makedirs(self.zips_path)
+    def reset(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
 
-        self._remove_binaries()
+    def span(self, name, category, **args):
+        """
+        Returns a context manager that records a span and yields its args dict, so the
+        caller can add details (e.g. a compressed size) while it runs. Yields None when
+        profiling is disabled.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, category, args)
+
+    @contextmanager
+    def _span(self, name, category, args):
+        read_start, written_start = _io_counters()
+        cpu_start = time.thread_time()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_start
+            read_end, written_end = _io_counters()
+            self.spans.append({
+                "name": name,
+                "category": category,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "start": start,
+                "wall": wall,
+                "cpu": cpu,
+                "read": None if read_start is None else read_end - read_start,
+                "written": None if written_start is None else written_end - written_start,
+                "peak_memory": _peak_memory(),
+                "args": args,
+            })
 
-        if self._generate_addons_file(addons_xml_path):
-            print(
-                "Successfully updated {}".format(color_text(addons_xml_path, 'yellow'))
+    def write_trace(self, path):
+        """
+        Writes the spans in the Chrome trace event format (chrome://tracing, Perfetto).
+        """
+        origin = min((span["start"] for span in self.spans), default=0)
+        events = []
+        for span in self.spans:
+            args = {
+                "cpu_s": span["cpu"],
+                "read_bytes": span["read"],
+                "written_bytes": span["written"],
+                "process_peak_memory_bytes": span["peak_memory"],
+            }
+            args.update(span["args"])
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": (span["start"] - origin) * 1e6,
+                "dur": span["wall"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _packaging_span(self):
+        # The addons are packaged by a "package" task each, which overlap; combined into a
+        # phase from the first one's start to the last one's end. Addons packaged in worker
+        # processes are waited for by the tasks, so the CPU time and I/O are their spans'.
+        tasks = [span for span in self.spans if span["category"] == "package"]
+        if not tasks:
+            return None
+        pid = os.getpid()
+        spans = tasks + [span for span in self.spans if span["category"] == "addon" and span["pid"] != pid]
+        start = min(span["start"] for span in tasks)
+
+        def total(key):
+            values = [span[key] for span in spans]
+            return None if None in values else sum(values)
+
+        return {
+            "name": "package",
+            "category": "phase",
+            "start": start,
+            "wall": max(span["start"] + span["wall"] for span in tasks) - start,
+            "cpu": total("cpu"),
+            "read": total("read"),
+            "written": total("written"),
+            "peak_memory": max(span["peak_memory"] or 0 for span in tasks) or None,
+        }
+
+    def print_summary(self, limit=10):
+        """
+        Prints the phases, and the slowest addons and zip members.
+        """
+        def size(value):
+            return "-" if value is None else "{:.1f} MiB".format(value / (1024 * 1024))
+
+        for category, title in [("phase", "Phases"), ("addon", "Slowest addons"), ("member", "Slowest files")]:
+            spans = [span for span in self.spans if span["category"] == category]
+            if category == "phase":
+                packaging = self._packaging_span()
+                if packaging is not None:
+                    spans = sorted(spans + [packaging], key=lambda span: span["start"])
+            else:
+                spans = sorted(spans, key=lambda span: span["wall"], reverse=True)[:limit]
+            if not spans:
+                continue
+            print(color_text(title, 'yellow'))
+            print("  {:<48} {:>9} {:>9} {:>12} {:>12} {:>12}".format(
+                "name", "wall", "cpu", "read", "written", "process peak"
+            ))
+            for span in spans:
+                print("  {:<48} {:>8.3f}s {:>8.3f}s {:>12} {:>12} {:>12}".format(
+                    span["name"][-48:], span["wall"], span["cpu"],
+                    size(span["read"]), size(span["written"]), size(span["peak_memory"]),
+                ))
+
+
+PROFILER = Profiler()
+
+
+class _TaskOutput:
+    """
+    Stands in for sys.stdout while a Scheduler runs. What a task prints is kept until the
+    task is done and then written at once, so the lines of tasks running at the same time
+    don't interleave. Output of other threads is written straight away.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def task(self):
+        buffer = self._local.buffer = io.StringIO()
+        try:
+            yield
+        finally:
+            del self._local.buffer
+            self._write(buffer.getvalue())
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self._write(text)
+        return buffer.write(text)
+
+    def _write(self, text):
+        with self._lock:
+            self.stream.write(text)
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self.stream.flush()
+
+
+class Scheduler:
+    """
+    Runs the tasks of a build in a pool of threads, each as soon as the tasks it depends
+    on are done, so independent work overlaps: e.g. addons are packaged while a submodule
+    of another one is still updating, and the index pages of a zip folder are written as
+    soon as the folder is final. Each task is profiled as a span.
+
+    Tasks may add more tasks while they run. A dependency has to be added before the
+    tasks that depend on it, so there can't be cycles. Tasks in a group are limited to
+    limits[group] at a time, e.g. to package no more addons at once than there are jobs.
+
+    When a task fails no more tasks are started, and run() raises its exception once the
+    running ones finished. What a task prints is written once it is done (see _TaskOutput).
+    """
+
+    def __init__(self, workers=None, limits=None):
+        self.workers = workers or (os.cpu_count() or 1) + 4
+        self.limits = limits or {}
+        self.tasks = {}  # name -> (func, args, deps, category, group)
+        self._added = []  # names of the tasks run() has not seen yet
+        self._lock = threading.Lock()
+        self._output = None
+
+    def add(self, name, func, *args, deps=(), category="task", group=None):
+        """
+        Adds a task that calls func(*args) after the tasks named in deps, and returns its name.
+        """
+        with self._lock:
+            if name in self.tasks:
+                raise ValueError("Task {} was already added".format(name))
+            for dep in deps:
+                if dep not in self.tasks:
+                    raise ValueError("Task {} depends on unknown task {}".format(name, dep))
+            self.tasks[name] = (func, args, tuple(deps), category, group)
+            self._added.append(name)
+        return name
+
+    def _run_task(self, name, func, args, category):
+        with self._output.task(), PROFILER.span(name, category):
+            func(*args)
+
+    def run(self):
+        """
+        Runs all tasks, and those they add, until they are done. Tasks are started in the
+        order they became ready.
+        """
+        order = itertools.count()
+        waiting = {}  # name -> number of dependencies not done yet
+        dependents = {}  # name -> names of the tasks waiting for it
+        ready = {}  # group -> heap of (order, name)
+        running = {}  # future -> name
+        group_running = {}  # group -> number of running tasks
+        done = set()
+        error = None
+
+        def make_ready(name):
+            heapq.heappush(ready.setdefault(self.tasks[name][4], []), (next(order), name))
+
+        self._output = _TaskOutput(sys.stdout)
+        with ExitStack() as stack:
+            # Restored once the executor is shut down, i.e. after the last task
+            stack.enter_context(redirect_stdout(self._output))
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.workers))
+            while True:
+                with self._lock:
+                    added, self._added = self._added, []
+                for name in added:
+                    deps = [dep for dep in self.tasks[name][2] if dep not in done]
+                    if deps:
+                        waiting[name] = len(deps)
+                        for dep in deps:
+                            dependents.setdefault(dep, []).append(name)
+                    else:
+                        make_ready(name)
+
+                while error is None:
+                    heads = [
+                        (heap[0], group) for group, heap in ready.items()
+                        if heap and (group is None or group_running.get(group, 0) < self.limits.get(group, self.workers))
+                    ]
+                    if not heads:
+                        break
+                    (_, name), group = min(heads)
+                    heapq.heappop(ready[group])
+                    func, args, deps, category, group = self.tasks[name]
+                    group_running[group] = group_running.get(group, 0) + 1
+                    running[executor.submit(self._run_task, name, func, args, category)] = name
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    group_running[self.tasks[name][4]] -= 1
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    done.add(name)
+                    for dependent in dependents.pop(name, []):
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            del waiting[dependent]
+                            make_ready(dependent)
+        if error is not None:
+            raise error
+        return done
+
+ManifestEntry = namedtuple("ManifestEntry", ["size", "mtime", "is_dir", "mtime_ns"], defaults=[0])
+
+
+class Manifest:
+    """
+    In-memory listing (sizes, mtimes and types) of the build trees. It is filled by a
+    single scan and kept up to date by every phase that writes or removes files, so a
+    build traverses each tree once and stats each file once. It also keeps the SHA-256
+    of the files hashed so far, see sha256().
+
+    Writing into a folder changes its mtime, so the folder is re-stat'ed lazily the
+    next time it is looked up.
+
+    It is safe to use from several threads, e.g. the tasks of a Scheduler.
+    """
+
+    def __init__(self):
+        self.tree = {}  # folder -> {name: ManifestEntry}
+        self.stale = set()
+        self.roots = []  # set by subset()
+        self.digests = {}  # file -> ((size, mtime_ns), sha256)
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def scan(self, path):
+        """
+        Adds path and everything below it to the manifest.
+        """
+        path = os.path.normpath(path)
+        if not os.path.exists(path):
+            return
+        stats = os.stat(path)
+        tree = {}
+        folders = [path] if S_ISDIR(stats.st_mode) else []
+        while folders:
+            folder = folders.pop()
+            children = tree[folder] = {}
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        stats_ = entry.stat()
+                    except OSError:
+                        # E.g. a dangling symlink: listed as a file, so only its addon fails to build
+                        stats_ = entry.stat(follow_symlinks=False)
+                    children[entry.name] = ManifestEntry(
+                        stats_.st_size, stats_.st_mtime, entry.is_dir(), stats_.st_mtime_ns
+                    )
+                    if entry.is_dir() and not entry.is_symlink():
+                        folders.append(os.path.join(folder, entry.name))
+        with self._lock:
+            self._set(path, stats)
+            for folder, children in tree.items():
+                self.tree.setdefault(folder, {}).update(children)
+
+    def record(self, path):
+        """
+        Records a file or folder that was just written.
+        """
+        path = os.path.normpath(path)
+        stats = os.stat(path)
+        with self._lock:
+            self._set(path, stats)
+
+    def remove(self, path):
+        """
+        Forgets a removed file or folder, including everything below it.
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        with self._lock:
+            self.tree.get(parent or ".", {}).pop(name, None)
+            self.stale.add(parent or ".")
+            for folder in list(self._folders(path)):
+                del self.tree[folder]
+
+    def get(self, path):
+        """
+        Returns the ManifestEntry of path, or None if it does not exist.
+        """
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        with self._lock:
+            if path in self.stale:
+                self.stale.discard(path)
+                if os.path.exists(path):
+                    self._set(path, os.stat(path), touch_parent=False)
+            return self.tree.get(parent or ".", {}).get(name)
+
+    def exists(self, path):
+        return self.get(path) is not None
+
+    def sha256(self, path):
+        """
+        Returns the SHA-256 of a file: from its .sha256 checksum file if it has one, which
+        was written along with it (see _save_checksums()), else hashed once for each size
+        and mtime it has.
+        """
+        path = os.path.normpath(path)
+        if self.isfile(path + ".sha256"):
+            try:
+                with open(path + ".sha256") as f:
+                    return f.read().split()[0]
+            except (OSError, IndexError):
+                pass
+        entry = self.get(path)
+        key = None if entry is None else (entry.size, entry.mtime_ns)
+        with self._lock:
+            cached = self.digests.get(path)
+        if cached is not None and key is not None and cached[0] == key:
+            return cached[1]
+        digest = _file_sha256(path)
+        with self._lock:
+            self.digests[path] = (key, digest)
+        return digest
+
+    def isfile(self, path):
+        entry = self.get(path)
+        return entry is not None and not entry.is_dir
+
+    def isdir(self, path):
+        entry = self.get(path)
+        return entry is not None and entry.is_dir
+
+    def listdir(self, path):
+        with self._lock:
+            return sorted(self.tree.get(os.path.normpath(path), {}))
+
+    def walk(self, top):
+        """
+        Same as os.walk(top) with sorted names, but served from the manifest.
+        """
+        with self._lock:
+            children = self.tree.get(os.path.normpath(top), {})
+            dirs = sorted(name for name, entry in children.items() if entry.is_dir)
+            files = sorted(name for name, entry in children.items() if not entry.is_dir)
+        yield top, dirs, files
+        for name in dirs:
+            yield from self.walk(os.path.join(top, name))
+
+    def subset(self, *paths):
+        """
+        Returns a new manifest with only the given paths and everything below them.
+        """
+        manifest = Manifest()
+        with self._lock:
+            for path in paths:
+                path = os.path.normpath(path)
+                manifest.roots.append(path)
+                parent, name = os.path.split(path)
+                entry = self.tree.get(parent or ".", {}).get(name)
+                if entry is not None:
+                    manifest.tree.setdefault(parent or ".", {})[name] = entry
+                for folder in self._folders(path):
+                    manifest.tree[folder] = dict(self.tree[folder])
+        return manifest
+
+    def update(self, other):
+        """
+        Replaces everything below the roots of a manifest made by subset() with its
+        entries, e.g. after a worker process added and removed files in it.
+        """
+        with self._lock:
+            for root in other.roots:
+                for folder in list(self._folders(root)):
+                    del self.tree[folder]
+                parent, name = os.path.split(root)
+                entry = other.tree.get(parent or ".", {}).get(name)
+                if entry is None:
+                    self.tree.get(parent or ".", {}).pop(name, None)
+                else:
+                    self.tree.setdefault(parent or ".", {})[name] = entry
+                for folder in other._folders(root):
+                    self.tree[folder] = dict(other.tree[folder])
+            self.stale |= other.stale
+
+    def _folders(self, path):
+        # Yields path and the folders below it that are in the manifest
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            children = self.tree.get(folder)
+            if children is None:
+                continue
+            yield folder
+            folders.extend(os.path.join(folder, name) for name, entry in children.items() if entry.is_dir)
+
+    def _set(self, path, stats, touch_parent=True):
+        parent, name = os.path.split(path)
+        parent = parent or "."
+        is_dir = S_ISDIR(stats.st_mode)
+        self.tree.setdefault(parent, {})[name] = ManifestEntry(stats.st_size, stats.st_mtime, is_dir, stats.st_mtime_ns)
+        if is_dir:
+            self.tree.setdefault(path, {})
+        if not touch_parent:
+            return
+        # The parent folder changed, and may have been created just now
+        while parent != ".":
+            self.stale.add(parent)
+            grandparent, parent_name = os.path.split(parent)
+            grandparent = grandparent or "."
+            if parent_name in self.tree.get(grandparent, {}):
+                break
+            self.tree.setdefault(grandparent, {})[parent_name] = ManifestEntry(0, 0, True)
+            parent = grandparent
+
+
+class GitTree:
+    """
+    The committed files of an addon folder, used to package from git (--from-git). One
+    ls-tree call lists them into a manifest with the same paths as the work tree has,
+    and their content is read through a single cat-file --batch process. Works alike
+    for submodules (their own HEAD) and for plain folders of this repo.
+    """
+
+    def __init__(self, folder, rev="HEAD"):
+        self.folder = os.path.normpath(folder)
+        self.blobs = {}
+        self.manifest = Manifest()
+        self.manifest.tree[self.folder] = {}
+        self._process = None
+        self._lock = threading.Lock()
+
+        # --full-tree, as ls-tree otherwise limits the listing to the folder within the tree
+        output = subprocess.run(
+            ["git", "-C", self.folder, "ls-tree", "-r", "-z", "-l", "--full-tree", rev + ":./"],
+            capture_output=True, check=True,
+        ).stdout
+        for line in output.decode("utf-8", "surrogateescape").split("\0"):
+            if not line:
+                continue
+            info, name = line.split("\t", 1)
+            mode, object_type, sha, size = info.split()
+            # Nested submodules and symlinks are not packaged
+            if object_type != "blob" or mode == "120000":
+                continue
+            path = os.path.join(self.folder, *name.split("/"))
+            self.blobs[path] = sha
+            self._add(path, ManifestEntry(int(size), 0, False))
+
+    def _add(self, path, entry):
+        parent, name = os.path.split(path)
+        self.manifest.tree.setdefault(parent, {})[name] = entry
+        if parent != self.folder and parent not in self.manifest.tree.get(os.path.dirname(parent), {}):
+            self.manifest.tree.setdefault(parent, {})
+            self._add(parent, ManifestEntry(0, 0, True))
+
+    def open(self, path):
+        """
+        Returns a file object with the committed content of path. It has to be closed
+        before the next file is opened.
+        """
+        if self._process is None:
+            self._process = subprocess.Popen(
+                ["git", "-C", self.folder, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
             )
+        self._process.stdin.write(self.blobs[os.path.normpath(path)].encode() + b"\n")
+        self._process.stdin.flush()
+        # "<sha> blob <size>", followed by the content and a newline
+        header = self._process.stdout.readline().split()
+        if len(header) != 3:
+            raise OSError("Could not read {} from git".format(path))
+        return _GitBlob(self._process.stdout, int(header[2]))
+
+    def read(self, path):
+        """
+        Returns the committed content of path. Unlike open(), safe to call from several threads.
+        """
+        with self._lock:
+            with self.open(path) as blob:
+                return blob.read()
+
+    def close(self):
+        # Ends the cat-file process; open() starts a new one when needed
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+
+class _GitBlob:
+    """
+    Read-only file object over one blob in the output of git cat-file --batch.
+    """
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        # Skip the unread content and the newline that ends it, so the next blob can be read
+        while self.remaining and self.read(ZIP_CHUNK_SIZE):
+            pass
+        self.stream.read(1)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AddonMetadata:
+    """
+    What the build needs from an addon.xml, read in a single parse: the id and version,
+    the art files it references (assets), the addons it requires as (id, version) pairs,
+    the xbmc.python version it runs on, whether a repository addon points Kodi to a
+    compressed addons.xml, the SHA-256 of the file and its <addon> element serialized
+    for addons.xml. Every phase reads from this instead of parsing the file again.
+
+    The id and version can also be read like the attributes of an <addon> element, so
+    metadata merges into addons.xml the same as the entries read from it.
+    """
+
+    __slots__ = ("id", "version", "assets", "requires", "python", "compressed", "source_hash", "xml")
+
+    def __init__(self, id, version, assets, requires, python, compressed, source_hash, xml):
+        self.id = id
+        self.version = version
+        self.assets = tuple(assets)
+        self.requires = tuple(tuple(item) for item in requires)
+        self.python = python
+        self.compressed = compressed
+        self.source_hash = source_hash
+        self.xml = xml
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Returns the metadata of the content of an addon.xml file.
+        """
+        root = ElementTree.fromstring(data)
+        assets = []
+        for ext in root.findall("extension"):
+            if ext.get("point") in ["xbmc.addon.metadata", "kodi.addon.metadata"]:
+                ext_assets = ext.find("assets")
+                if ext_assets is None:
+                    continue
+                assets.extend(os.path.normpath(art.text) for art in ext_assets if art.text)
+        requires = [(item.get("addon"), item.get("version")) for item in root.findall("requires/import")]
+        info = root.find(".//dir/info")
+        return cls(
+            id=root.get("id"),
+            version=root.get("version"),
+            assets=assets,
+            requires=requires,
+            python=dict(requires).get("xbmc.python"),
+            compressed=info is not None and info.get("compressed", "false").lower() == "true",
+            source_hash=hashlib.sha256(data).hexdigest(),
+            xml=ElementTree.tostring(root, encoding="unicode"),
+        )
+
+    @classmethod
+    def read(cls, addon_xml_path):
+        with open(addon_xml_path, "rb") as f:
+            return cls.parse(f.read())
+
+    def get(self, key, default=None):
+        return {"id": self.id, "version": self.version}.get(key, default)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class MetadataCache:
+    """
+    The AddonMetadata of the addon.xml files of earlier builds, keyed by a hash of the
+    file (or its git blob id), so an addon.xml that did not change is not parsed again.
+    Stored in METADATA_CACHE; entries that a full build did not use are dropped on save.
+    """
+
+    def __init__(self, path=METADATA_CACHE):
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        self.changed = False
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+            if cache.get("version") == CACHE_VERSION:
+                self.entries = cache["addons"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get(self, key, read):
+        """
+        Returns the metadata of the addon.xml with hash key, calling read() for the
+        content of the file when it has to be parsed.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            metadata = AddonMetadata.parse(read())
+            entry = self.entries[key] = metadata.to_dict()
+            self.changed = True
+        else:
+            metadata = AddonMetadata(**entry)
+        self.used[key] = entry
+        return metadata
+
+    def save(self, prune=True):
+        if prune and len(self.used) != len(self.entries):
+            self.entries = dict(self.used)
+            self.changed = True
+        self.used = {}
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"version": CACHE_VERSION, "addons": self.entries}, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.changed = False
+
+
+def _version_tuple(version):
+    # "2.26.0" -> (2, 26, 0), ignoring anything after the digits of a part ("1.0.0~beta")
+    parts = []
+    for part in version.split("."):
+        digits = ""
+        for char in part:
+            if not char.isdigit():
+                break
+            digits += char
+        parts.append(int(digits or 0))
+    return tuple(parts)
+
+
+def _addon_targets(python, targets):
+    """
+    Returns the targets an addon can be published to, based on the xbmc.python version
+    it requires. Addons without that requirement (e.g. repositories) go to every target.
+    """
+    if not python:
+        return list(targets)
+    version = _version_tuple(python)
+    return [
+        target
+        for target in targets
+        if target not in KODI_PYTHON_ABI
+        or _version_tuple(KODI_PYTHON_ABI[target][0]) <= version <= _version_tuple(KODI_PYTHON_ABI[target][1])
+    ]
+
+
+def _read_addon_versions(addons_xml_path):
+    """
+    Returns a dict of addon id to version for an existing addons.xml, and whether its
+    entries are sorted by id. Entries are discarded while parsing to keep memory bounded.
+    """
+    versions = {}
+    is_sorted = True
+    last_id = None
+    for entry in _iter_addon_entries(addons_xml_path):
+        id = entry.get('id')
+        if id in versions:
+            is_sorted = False
+        else:
+            versions[id] = entry.get('version')
+        if last_id is not None and id < last_id:
+            is_sorted = False
+        last_id = id
+    return versions, is_sorted
+
+
+def _iter_addon_entries(addons_xml_path):
+    """
+    Yields the <addon> elements of an addons.xml one by one. Each element is
+    released once the next one is requested, so only one entry is held in memory.
+    """
+    if not os.path.exists(addons_xml_path):
+        return
+    depth = 0
+    root = None
+    for event, elem in ElementTree.iterparse(addons_xml_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == "addon":
+            yield elem
+            root.clear()
+
+
+def _merge_addon_entries(existing, new_entries, existing_versions, keep_ids=None):
+    """
+    Merges the new or updated addon elements or AddonMetadata (a dict keyed by id) into the existing
+    entries, which must be sorted by id. An updated addon replaces its existing entry in
+    place; new addons are merged in by id. Existing entries whose id is not in keep_ids
+    are dropped. Runs in linear time on the sorted inputs.
+    """
+    replacements = {id: entry for id, entry in new_entries.items() if id in existing_versions}
+    added = sorted(
+        (entry for id, entry in new_entries.items() if id not in existing_versions),
+        key=lambda addon: addon.get('id'),
+    )
+
+    def replaced():
+        for entry in existing:
+            id = entry.get('id')
+            if keep_ids is None or id in keep_ids or id in replacements:
+                yield replacements.pop(id, entry)
+
+    return heapq.merge(replaced(), added, key=lambda addon: addon.get('id'))
+
+
+def _write_addons_xml(out, entries):
+    """
+    Serializes the addon elements (or the already serialized ones of AddonMetadata)
+    one by one into an addons.xml document.
+    Produces the same bytes as ElementTree.write(encoding="utf-8", xml_declaration=True).
+    """
+    out.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+    empty = True
+    for entry in entries:
+        if empty:
+            out.write(b"<addons>")
+            empty = False
+        if isinstance(entry, AddonMetadata):
+            out.write(entry.xml.encode("utf-8"))
+        else:
+            out.write(ElementTree.tostring(entry, encoding="unicode").encode("utf-8"))
+    out.write(b"<addons />" if empty else b"</addons>")
+
+
+class _HashingWriter:
+    """
+    Write-only file wrapper that computes the MD5 and SHA-256 digests of
+    everything written through it, so checksums need no second read.
+    It deliberately cannot seek: ZipFile then streams members with data
+    descriptors instead of rewriting headers that were already hashed.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.position += len(data)
+        return self.file.write(data)
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def flush(self):
+        self.file.flush()
+
+
+class _TeeWriter:
+    """
+    Write-only file wrapper that forwards every write to several files.
+    """
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for file in self.files:
+            file.write(data)
+        return len(data)
+
+    def flush(self):
+        for file in self.files:
+            file.flush()
+
+
+def _save_checksums(hashes, file):
+    """
+    Saves the .md5 and .sha256 checksum files of a file written through a _HashingWriter.
+    Returns the paths of the checksum files.
+    """
+    md5_path = file + ".md5"
+    sha256_path = file + ".sha256"
+    _save_file(hashes.md5.hexdigest(), file=md5_path)
+    _save_file(hashes.sha256.hexdigest(), file=sha256_path)
+    return [md5_path, sha256_path]
+
+
+def _write_member(zipf, zinfo, crc, data):
+    """
+    Writes a member whose data (bytes or a file) is already compressed (or stored) to a
+    ZipFile that writes to an unseekable file. The bytes are the same ZipFile.open() writes when streaming the
+    member: the local header, the data and a data descriptor with the CRC and sizes.
+    """
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.flag_bits = 0x08  # sizes and CRC follow in a data descriptor
+    zinfo.CRC = 0
+    zinfo.compress_size = 0
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader(zip64))
+    if isinstance(data, bytes):
+        zipf.fp.write(data)
+        zinfo.compress_size = len(data)
+    else:
+        # A file, e.g. in the member cache, copied in chunks
+        for chunk in iter(lambda: data.read(ZIP_CHUNK_SIZE), b""):
+            zipf.fp.write(chunk)
+            zinfo.compress_size += len(chunk)
+    zinfo.CRC = crc
+    zipf.fp.write(struct.pack(
+        "<LLQQ" if zip64 else "<LLLL", 0x08074b50, zinfo.CRC, zinfo.compress_size, zinfo.file_size
+    ))
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _deflate_into(out, chunks, level=None):
+    """
+    Writes the raw deflate stream of chunks to out, the same ZipFile writes for a member
+    written in these chunks, and returns the size and CRC of the uncompressed data.
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+    size = crc = 0
+    for chunk in chunks:
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        out.write(compressor.compress(chunk))
+    out.write(compressor.flush())
+    return size, crc
+
+
+@contextmanager
+def _cache_writer(path):
+    """
+    Opens a file in one of the build caches for writing. It is written under a unique
+    name and only moved into place when complete, as other processes and threads may
+    store the same entry at the same time.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _optimise_png(data):
+    """
+    Returns a PNG with its image data deflated again at the highest level into a single
+    IDAT chunk, without text and time chunks. The pixels stay the same. Returns data
+    itself when it can't be parsed or the result isn't smaller.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = []
+    idat = []
+    pos = len(PNG_SIGNATURE)
+    try:
+        while pos < len(data):
+            length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+            body = data[pos + 8:pos + 8 + length]
+            if len(body) != length:
+                return data
+            if chunk_type == b"IDAT":
+                if not idat:
+                    chunks.append((chunk_type, None))
+                idat.append(body)
+            elif chunk_type not in PNG_STRIPPED_CHUNKS:
+                chunks.append((chunk_type, body))
+            pos += length + 12
+            if chunk_type == b"IEND":
+                break
+        raw = zlib.decompress(b"".join(idat)) if idat else None
+    except (struct.error, zlib.error):
+        return data
+    if raw is None:
+        return data
+
+    candidates = []
+    for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidates.append(compressor.compress(raw) + compressor.flush())
+    image_data = min(candidates, key=len)
+
+    out = [PNG_SIGNATURE]
+    for chunk_type, body in chunks:
+        if body is None:
+            body = image_data
+        out.append(struct.pack(">I", len(body)) + chunk_type + body)
+        out.append(struct.pack(">I", zlib.crc32(chunk_type + body)))
+    optimised = b"".join(out)
+    return optimised if len(optimised) < len(data) else data
+
+
+def _exif_orientation(tiff):
+    # The orientation tag of the first IFD of Exif data, None if it has none
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        offset = struct.unpack(order + "I", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            tag = struct.unpack(order + "H", tiff[entry:entry + 2])[0]
+            if tag == 0x0112:
+                return struct.unpack(order + "H", tiff[entry + 8:entry + 10])[0]
+    except (KeyError, struct.error):
+        return None
+    return None
+
+
+def _keep_jpeg_segment(marker, payload):
+    # Metadata segments are dropped, except the ones that change how the image is shown
+    if marker == 0xFE:  # COM
+        return False
+    if not 0xE0 <= marker <= 0xEF:
+        return True
+    if marker == 0xE0:
+        return payload.startswith(b"JFIF\0")
+    if marker == 0xE1:
+        return payload.startswith(b"Exif\0\0") and _exif_orientation(payload[6:]) not in (None, 1)
+    if marker == 0xE2:
+        return payload.startswith(b"ICC_PROFILE\0")
+    if marker == 0xEE:
+        return payload.startswith(b"Adobe")
+    return False
+
+
+def _optimise_jpeg(data):
+    """
+    Returns a JPEG without comments and metadata segments (Exif, XMP, thumbnails, ...).
+    The JFIF header, the ICC profile, the Adobe colour transform and an Exif orientation
+    are kept, and the image data is copied as is. Returns data itself when it can't be
+    parsed or nothing was stripped.
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return data
+    out = [data[:2]]
+    pos = 2
+    while True:
+        if pos + 4 > len(data) or data[pos] != 0xFF:
+            return data
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte before a marker
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):  # Start of scan: the rest is image data
+            out.append(data[pos:])
+            break
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # Markers without a segment
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        end = pos + 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if end > len(data) or end < pos + 4:
+            return data
+        if _keep_jpeg_segment(marker, data[pos + 4:end]):
+            out.append(data[pos:end])
+        pos = end
+    optimised = b"".join(out)
+    return optimised if len(optimised) < len(data) else data
 
-            if self._generate_md5_file(addons_xml_path, md5_path):
-                print("Successfully updated {}".format(color_text(md5_path, 'yellow')))
 
-    def _remove_binaries(self):
+class Generator:
+    """
+    Generates a new addons.xml file from each addons addon.xml file
+    and new addons.xml.md5 and addons.xml.sha256 hash files. Must be run
+    from the root of the checked-out repo.
+
+    Each addon is packaged once into the build cache (see _cache_key()) and
+    placed from there into the zips folder, and into the tree of each Kodi
+    version in targets that runs it (see KODI_VERSIONS). The build runs on a
+    Scheduler, see schedule(); with build=False it is not started yet.
+    """
+
+    def __init__(
+        self, jobs=1, force=False, compression="auto", compress_level=None, gzip=None, manifest=None,
+        link_mode="auto", targets=None, from_git=False, zip_threads=0, optimise_images=False, build=True,
+    ):
+        self.jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+        self.zip_threads = zip_threads if zip_threads > 0 else max(1, (os.cpu_count() or 1) // self.jobs)
+        self.link_mode = link_mode
+        self.from_git = from_git
+        self._git_trees = {}
+        self._file_hashes = {}  # addon folder -> {source file: content hash}, see _cache_key()
+        self._image_digests = {}  # addon folder -> digests of the images optimised for its build
+        self.addons = {}  # addon folder -> AddonMetadata
+        self._scanned = {}  # (id, version) -> (addon folder, AddonMetadata, targets) of the current build
+        self._lock = threading.Lock()
+        self.force = force
+        self.compression = compression
+        self.compress_level = compress_level
+        self.optimise_images = optimise_images
+        self.targets = [target for target in KODI_VERSIONS if target == "repo" or target in (targets or [])]
+        self.release_path = ''
+        self.cache_path = os.path.join(self.release_path, CACHE_PATH)
+        self.addon_path = os.path.join(self.release_path, "repo")
+        self.zips_path = os.path.join(self.release_path, "zips")
+        # All file system lookups go through the manifest
+        if manifest is None:
+            manifest = Manifest()
+            manifest.scan(self.addon_path)
+            manifest.scan(self.zips_path)
+        self.manifest = manifest
+        self.metadata_cache = MetadataCache(os.path.join(self.cache_path, "metadata.json"))
+        self.gzip = gzip
+        self.addons_xml_gz_hashes = None
+
+        if build:
+            self._build()
+
+    def __getstate__(self):
+        # Worker processes only get the manifest and metadata of the addon they package
+        state = self.__dict__.copy()
+        state["manifest"] = None
+        state["addons"] = {}
+        state["_scanned"] = {}
+        state["metadata_cache"] = None
+        state["_git_trees"] = {}
+        state["_file_hashes"] = {}
+        state["_image_digests"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _make_target_paths(self):
+        for target in self.targets:
+            target_path = self._target_path(target)
+            if not self.manifest.isdir(target_path):
+                os.makedirs(target_path)
+                self.manifest.record(target_path)
+
+    def _target_path(self, target):
+        # The "repo" target is the zips folder itself
+        if target == "repo":
+            return self.zips_path
+        return os.path.join(self.zips_path, target)
+
+    def _git_tree(self, folder):
+        if folder not in self._git_trees:
+            self._git_trees[folder] = GitTree(os.path.join(self.addon_path, folder))
+        return self._git_trees[folder]
+
+    def _source_manifest(self, folder):
+        # The files of an addon folder: committed ones with from_git, else the work tree
+        return self._git_tree(folder).manifest if self.from_git else self.manifest
+
+    def _open_source(self, folder, file_path):
+        if self.from_git:
+            return self._git_tree(folder).open(file_path)
+        return open(file_path, "rb")
+
+    def _read_source(self, folder, file_path):
+        # Whole content of a source file, from any thread
+        if self.from_git:
+            return self._git_tree(folder).read(file_path)
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    def _optimises(self, file_path):
+        return self.optimise_images and os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+
+    def _optimise_image(self, folder, file_path, data):
         """
-        Removes any and all compiled Python files before operations.
+        Returns the losslessly optimised content of a PNG or JPEG image, from the image
+        cache if the same image was optimised before.
         """
+        digest = hashlib.sha256(data).hexdigest()
+        self._image_digests.setdefault(folder, set()).add(digest)
+        cache_file = os.path.join(self.cache_path, "images", digest[:2], digest)
+        try:
+            with open(cache_file, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
 
-        for parent, dirnames, filenames in os.walk(self.release_path):
+        if os.path.splitext(file_path)[1].lower() == ".png":
+            optimised = _optimise_png(data)
+        else:
+            optimised = _optimise_jpeg(data)
+        with _cache_writer(cache_file) as f:
+            f.write(optimised)
+        return optimised
+
+    def _use_cached_image(self, folder, file_path):
+        # Records the image cache entry of an image taken from the member cache as used, like
+        # _optimise_image() does. The content hash of _cache_key() is the entry's, unless it
+        # is a git blob id.
+        digest = self._file_hashes.get(folder, {}).get(file_path)
+        if digest is None or digest.startswith("git-"):
+            digest = hashlib.sha256(self._read_source(folder, file_path)).hexdigest()
+        self._image_digests.setdefault(folder, set()).add(digest)
+
+    def _prune_image_cache(self, addon_ids):
+        """
+        Removes the optimised images from the image cache that the cached builds of the
+        given addons don't use, e.g. of images that changed or addons that were removed.
+        """
+        images_path = os.path.join(self.cache_path, "images")
+        if not os.path.isdir(images_path):
+            return
+        used = set()
+        for addon_id in addon_ids:
+            try:
+                with open(os.path.join(self.cache_path, addon_id, "images")) as f:
+                    used.update(f.read().split())
+            except FileNotFoundError:
+                pass
+        for prefix in os.listdir(images_path):
+            folder = os.path.join(images_path, prefix)
+            for name in os.listdir(folder):
+                if name not in used:
+                    os.remove(os.path.join(folder, name))
+            if not os.listdir(folder):
+                os.rmdir(folder)
+
+    def _repository_compressed(self):
+        """
+        Returns True if the repository addon.xml tells Kodi to fetch a compressed addons.xml,
+        which decides whether an addons.xml.gz is written unless gzip was given.
+        """
+        metadata = self.addons.get("repository.verkurkie")
+        return metadata is not None and metadata.compressed
+
+    def _addon_metadata(self, folder):
+        """
+        Returns the AddonMetadata of an addon folder, from the metadata cache unless its
+        addon.xml changed.
+        """
+        addon_xml_path = os.path.join(self.addon_path, folder, "addon.xml")
+        if self.from_git:
+            # The blob id identifies the content, so a cached addon.xml is not even read
+            key = "git-" + self._git_tree(folder).blobs[os.path.normpath(addon_xml_path)]
+            metadata = self.metadata_cache.get(key, lambda: self._read_source(folder, addon_xml_path))
+            # Keeps the listing for packaging, but not a cat-file process per addon
+            self._git_tree(folder).close()
+            return metadata
+        with open(addon_xml_path, "rb") as f:
+            data = f.read()
+        return self.metadata_cache.get(hashlib.sha256(data).hexdigest(), lambda: data)
+
+    def _remove_binaries(self, folder=None):
+        """
+        Removes any and all compiled Python files from the addon sources (or only from one
+        addon folder) before operations.
+        """
+
+        top = self.addon_path if folder is None else os.path.join(self.addon_path, folder)
+        for parent, dirnames, filenames in self.manifest.walk(top):
             for fn in filenames:
                 if fn.lower().endswith("pyo") or fn.lower().endswith("pyc"):
                     compiled = os.path.join(parent, fn)
                     try:
                         os.remove(compiled)
+                        self.manifest.remove(compiled)
                         print(
                             "Removed compiled python file: {}".format(
                                 color_text(compiled, 'green')
@@ -385,11 +1988,13 @@ class Generator:
                                 color_text(compiled, 'red'), color_text(e, 'red')
                             )
                         )
-            for dir in dirnames:
+            for dir in list(dirnames):
                 if "pycache" in dir.lower():
                     compiled = os.path.join(parent, dir)
                     try:
                         shutil.rmtree(compiled)
+                        self.manifest.remove(compiled)
+                        dirnames.remove(dir)
                         print(
                             "Removed __pycache__ cache folder: {}".format(
                                 color_text(compiled, 'green')
@@ -402,13 +2007,11 @@ class Generator:
                             )
                         )
 
-    def build_zip(self, folder, addon_id, version):
-        zip_name = f"{addon_id}-{version}.zip"
+    def _zip_files(self, folder, addon_id, verbose=True):
+        """
+        Returns the (file path, archive name) pairs to include in the zip of an addon.
+        """
         addon_folder = os.path.join(self.addon_path, folder)
-        zip_folder = os.path.join(self.zips_path, addon_id)
-        if not os.path.exists(zip_folder):
-            os.makedirs(zip_folder)
-        final_zip = os.path.join(zip_folder, "{0}-{1}.zip".format(addon_id, version))
 
         # Files and directories to include as per RELEASE.md
         contents = {
@@ -428,169 +2031,1141 @@ class Generator:
             contents["repo"] if addon_id == "repository.verkurkie" else contents["addon"]
         )
 
-        with zipfile.ZipFile(final_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for item in includes:
-                item_path = os.path.join(addon_folder, item)
-                if not os.path.exists(item_path):
+        manifest = self._source_manifest(folder)
+        files_to_zip = []
+        for item in includes:
+            item_path = os.path.join(addon_folder, item)
+            entry = manifest.get(item_path)
+            if entry is None:
+                if verbose:
                     print(f"Warning: [{item_path}] not found, skipping.")
-                    continue
+                continue
 
-                files_to_zip = []
-                if os.path.isfile(item_path):
-                    files_to_zip.append((item_path, os.path.join(addon_id, item)))
-                elif os.path.isdir(item_path):
-                    for root, dirs, files in os.walk(item_path):
-                        dirs.sort()
-                        if "__pycache__" in dirs:
-                            dirs.remove("__pycache__")
-
-                        for file in sorted(files):
-                            file_path = os.path.join(root, file)
-                            # Calculate arcname relative to the parent of item, then prefix with addon_id
-                            rel_path = os.path.relpath(file_path, addon_folder)
-                            arcname = os.path.join(addon_id, rel_path)
-                            files_to_zip.append((file_path, arcname))
-
-                for file_path, arcname in files_to_zip:
-                    # Deterministic zip writing: fixed timestamp and permissions
-                    zinfo = zipfile.ZipInfo(arcname)
-                    zinfo.date_time = (2000, 1, 1, 0, 0, 0)
-                    zinfo.compress_type = zipfile.ZIP_DEFLATED
-                    zinfo.external_attr = 0o100644 << 16  # -rw-r--r--
-
-                    with open(file_path, "rb") as f:
-                        zipf.writestr(zinfo, f.read())
-
-        print("Successfully updated {}".format(color_text(final_zip, 'yellow')))
+            if not entry.is_dir:
+                files_to_zip.append((item_path, os.path.join(addon_id, item)))
+            else:
+                for root, dirs, files in manifest.walk(item_path):
+                    if "__pycache__" in dirs:
+                        dirs.remove("__pycache__")
+
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        # Calculate arcname relative to the parent of item, then prefix with addon_id
+                        rel_path = os.path.relpath(file_path, addon_folder)
+                        arcname = os.path.join(addon_id, rel_path)
+                        files_to_zip.append((file_path, arcname))
+        return files_to_zip
+
+    def _compress_type(self, file_path, sample):
+        """
+        Returns the compression method of a zip member according to the compression policy.
+        sample is the start of the file (up to PROBE_SIZE bytes), probed by the auto policy.
+        """
+        if self.compression == "deflate":
+            return zipfile.ZIP_DEFLATED
+        if os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        if self.compression == "auto":
+            # Quick probe: if the start of the file barely compresses, the rest won't either
+            if sample and len(zlib.compress(sample, 1)) >= len(sample) * PROBE_RATIO:
+                return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _member_key(self, folder, file_path):
+        """
+        Returns the key of a zip member in the member cache: a hash over its content and
+        everything that decides how it is compressed. None when the content hash of the
+        file is not known, i.e. it was not hashed by _cache_key().
+        """
+        content = self._file_hashes.get(folder, {}).get(file_path)
+        if content is None:
+            return None
+        return hashlib.sha256(
+            "{}\0{}\0{}\0{}\0{}\0{}".format(
+                CACHE_VERSION, self.compression, self.compress_level, self._optimises(file_path),
+                os.path.splitext(file_path)[1].lower(), content,
+            ).encode()
+        ).hexdigest()
+
+    def _cached_member(self, cache_file):
+        """
+        Returns the compression method, size and CRC of a member in the member cache and
+        the cache file, open at the start of the compressed data. None if it isn't cached.
+        """
+        if cache_file is None:
+            return None
+        try:
+            f = open(cache_file, "rb")
+        except FileNotFoundError:
+            return None
+        compress_type, crc, size = MEMBER_HEADER.unpack(f.read(MEMBER_HEADER.size))
+        return compress_type, size, crc, f
 
-    def _copy_meta_files(self, addon_id, addon_folder):
+    def _compress_member(self, folder, file_path, arcname, cache_file=None):
         """
-        Copy the addon.xml and relevant art files into the relevant folders in the repository.
+        Reads a zip member and compresses it according to the compression policy, in a
+        worker thread of build_zip(). Returns its compression method, size, CRC and data,
+        and whether the data came from the member cache. The deflate stream gets the same
+        pieces the streaming path feeds ZipFile, so the output is the same.
+
+        With a cache_file, a deflated member is taken from the member cache if it is
+        there, and stored in it otherwise.
+        """
+        with PROFILER.span(arcname, "member") as span:
+            cached = self._cached_member(cache_file)
+            if cached is not None:
+                compress_type, size, crc, f = cached
+                with f:
+                    compressed = f.read()
+                if span is not None:
+                    span.update(size=size, compress_size=len(compressed), cached=True)
+                if self._optimises(file_path):
+                    self._use_cached_image(folder, file_path)
+                return compress_type, size, crc, compressed, True
+
+            data = self._read_source(folder, file_path)
+            if self._optimises(file_path):
+                data = self._optimise_image(folder, file_path, data)
+            compress_type = self._compress_type(file_path, data[:PROBE_SIZE])
+            if compress_type == zipfile.ZIP_DEFLATED:
+                view = memoryview(data)
+                chunks = [view[offset:offset + ZIP_CHUNK_SIZE] for offset in range(PROBE_SIZE, len(data), ZIP_CHUNK_SIZE)]
+                out = io.BytesIO()
+                size, crc = _deflate_into(out, [view[:PROBE_SIZE]] + chunks, self.compress_level)
+                compressed = out.getvalue()
+                if cache_file is not None:
+                    with _cache_writer(cache_file) as f:
+                        f.write(MEMBER_HEADER.pack(compress_type, crc, size))
+                        f.write(compressed)
+            else:
+                size, crc, compressed = len(data), zlib.crc32(data), data
+            if span is not None:
+                span.update(size=size, compress_size=len(compressed))
+        return compress_type, size, crc, compressed, False
+
+    def _stream_member(self, zipf, zinfo, folder, file_path, cache_file=None):
         """
+        Writes a member too large to hold in memory, in chunks. With a cache_file, a
+        deflated member is compressed into the member cache first (unless it is there
+        already) and copied from there into the zip. Returns whether it was cached.
+        """
+        cached = self._cached_member(cache_file)
+        if cached is None:
+            with self._open_source(folder, file_path) as f:
+                sample = f.read(PROBE_SIZE)
+                zinfo.compress_type = self._compress_type(file_path, sample)
+                if cache_file is None or zinfo.compress_type != zipfile.ZIP_DEFLATED:
+                    with zipf.open(zinfo, "w") as dest:
+                        dest.write(sample)
+                        shutil.copyfileobj(f, dest, ZIP_CHUNK_SIZE)
+                    return False
+                with _cache_writer(cache_file) as out:
+                    # The header is filled in once the size and CRC are known
+                    out.seek(MEMBER_HEADER.size)
+                    chunks = itertools.chain([sample], iter(lambda: f.read(ZIP_CHUNK_SIZE), b""))
+                    size, crc = _deflate_into(out, chunks, self.compress_level)
+                    out.seek(0)
+                    out.write(MEMBER_HEADER.pack(zinfo.compress_type, crc, size))
+            was_cached = False
+            cached = self._cached_member(cache_file)
+        else:
+            was_cached = True
+        zinfo.compress_type, zinfo.file_size, crc, f = cached
+        with f:
+            _write_member(zipf, zinfo, crc, f)
+        return was_cached
 
-        tree = ElementTree.parse(os.path.join(self.addon_path, addon_id, "addon.xml"))
-        root = tree.getroot()
+    def build_zip(self, folder, addon_id, version, zip_folder=None):
+        """
+        Zips an addon folder, with each member compressed according to the compression
+        policy (see COMPRESSION_POLICIES), and writes the checksum files of the zip.
+        Returns the bytes saved by optimising images.
+
+        Members up to PARALLEL_MEMBER_SIZE are read and deflated in a pool of zip_threads
+        threads and written in their usual order, so the zip is the same as one deflated
+        member by member; larger ones are streamed. Deflated members are kept in a member
+        cache per addon, keyed by their content and the compression settings, so a new
+        version of an addon only compresses the files that changed.
+        """
+        if zip_folder is None:
+            zip_folder = os.path.join(self.zips_path, addon_id)
+        if not self.manifest.isdir(zip_folder):
+            os.makedirs(zip_folder, exist_ok=True)
+        final_zip = os.path.join(zip_folder, "{0}-{1}.zip".format(addon_id, version))
 
-        copyfiles = ["addon.xml"]
-        for ext in root.findall("extension"):
-            if ext.get("point") in ["xbmc.addon.metadata", "kodi.addon.metadata"]:
-                assets = ext.find("assets")
-                if assets is None:
+        manifest = self._source_manifest(folder)
+        files = self._zip_files(folder, addon_id)
+        # Compressed members of earlier builds of the addon, by member key
+        members_path = os.path.join(self.cache_path, addon_id, "members")
+        if self.force and os.path.isdir(members_path):
+            shutil.rmtree(members_path)
+        used_members = set()
+        cpu_start = time.process_time()
+        with ExitStack() as stack:
+            executor = None
+            if self.zip_threads > 1 and len(files) > 1:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.zip_threads))
+            zip_file = stack.enter_context(open(final_zip, "wb"))
+            hashes = _HashingWriter(zip_file)
+            zipf = stack.enter_context(zipfile.ZipFile(hashes, "w", zipfile.ZIP_DEFLATED))
+            # Members being compressed by the pool, written in order as they complete
+            pending = deque()
+            # Optimised images and their original size, and the members taken from the member cache
+            optimised = []
+            reused = []
+
+            def write_member(zinfo, result):
+                zinfo.compress_type, zinfo.file_size, crc, data, cached = result
+                _write_member(zipf, zinfo, crc, data)
+                if cached:
+                    reused.append(zinfo)
+
+            def write_pending(limit):
+                while len(pending) > limit:
+                    zinfo, future = pending.popleft()
+                    write_member(zinfo, future.result())
+
+            for file_path, arcname in files:
+                # Deterministic zip writing: fixed timestamp and permissions
+                zinfo = zipfile.ZipInfo(arcname)
+                zinfo.date_time = (2000, 1, 1, 0, 0, 0)
+                # ZipFile.open() only honours the per-member level
+                zinfo._compresslevel = self.compress_level
+                zinfo.external_attr = 0o100644 << 16  # -rw-r--r--
+                # Known up front so large members get their zip64 header before streaming
+                zinfo.file_size = manifest.get(file_path).size
+
+                key = self._member_key(folder, file_path)
+                cache_file = None
+                if key is not None:
+                    cache_file = os.path.join(members_path, key)
+                    used_members.add(key)
+                # Images are optimised as a whole, so they are never streamed
+                image = self._optimises(file_path)
+                if image:
+                    optimised.append((zinfo, zinfo.file_size))
+                in_memory = image or (
+                    zinfo.file_size <= PARALLEL_MEMBER_SIZE and (executor is not None or cache_file is not None)
+                )
+                if executor is not None and in_memory:
+                    pending.append(
+                        (zinfo, executor.submit(self._compress_member, folder, file_path, arcname, cache_file))
+                    )
+                    # Bounds the members held in memory
+                    write_pending(2 * self.zip_threads)
+                    continue
+                write_pending(0)
+                if in_memory:
+                    write_member(zinfo, self._compress_member(folder, file_path, arcname, cache_file))
                     continue
-                for art in [a for a in assets if a.text]:
-                    copyfiles.append(os.path.normpath(art.text))
+
+                # Stream the file in chunks to keep memory use independent of the file size
+                with PROFILER.span(arcname, "member") as span:
+                    if self._stream_member(zipf, zinfo, folder, file_path, cache_file):
+                        reused.append(zinfo)
+                    if span is not None:
+                        span.update(size=zinfo.file_size, compress_size=zinfo.compress_size)
+            write_pending(0)
+            members = zipf.infolist()
+        cpu_time = time.process_time() - cpu_start
+        self.manifest.record(final_zip)
+        # Drops the members of earlier builds that are not part of this one
+        if os.path.isdir(members_path):
+            for name in os.listdir(members_path):
+                if name not in used_members:
+                    os.remove(os.path.join(members_path, name))
+        for checksum_path in _save_checksums(hashes, final_zip):
+            self.manifest.record(checksum_path)
+
+        stored = [m for m in members if m.compress_type == zipfile.ZIP_STORED]
+        total_size = sum(m.file_size for m in members)
+        total_compressed = sum(m.compress_size for m in members)
+        print("Successfully built {}".format(color_text(os.path.basename(final_zip), 'yellow')))
+        print(
+            "- {} files ({} stored, {} bytes not deflated, {} from the member cache), {} bytes saved, {:.3f}s CPU".format(
+                len(members),
+                len(stored),
+                sum(m.file_size for m in stored),
+                len(reused),
+                total_size - total_compressed,
+                cpu_time,
+            )
+        )
+        return sum(size - zinfo.file_size for zinfo, size in optimised)
+
+    def _meta_files(self, folder):
+        """
+        Returns the addon.xml and the art files it references, relative to the addon folder.
+        """
+        return ["addon.xml"] + list(self.addons[folder].assets)
+
+    def _copy_meta_files(self, addon_id, addon_folder):
+        """
+        Copy the addon.xml and relevant art files into the relevant folders in the repository.
+        Returns the bytes saved by optimising images.
+        """
 
         src_folder = os.path.join(self.addon_path, addon_id)
-        for file in copyfiles:
+        manifest = self._source_manifest(addon_id)
+        saved = 0
+        for file in self._meta_files(addon_id):
             addon_path = os.path.join(src_folder, file)
-            if not os.path.exists(addon_path):
+            if not manifest.isfile(addon_path):
                 continue
 
             zips_path = os.path.join(addon_folder, file)
             asset_path = os.path.split(zips_path)[0]
-            if not os.path.exists(asset_path):
+            if not self.manifest.isdir(asset_path):
                 os.makedirs(asset_path)
 
-            shutil.copy(addon_path, zips_path)
-
-    def _generate_addons_file(self, addons_xml_path):
+            if self._optimises(addon_path):
+                data = self._read_source(addon_id, addon_path)
+                optimised = self._optimise_image(addon_id, addon_path, data)
+                with open(zips_path, "wb") as f:
+                    f.write(optimised)
+                saved += len(data) - len(optimised)
+            elif self.from_git:
+                with self._open_source(addon_id, addon_path) as src, open(zips_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, ZIP_CHUNK_SIZE)
+            else:
+                # Never a hard link, so editing a source can't alter a cached build
+                _place_file(addon_path, zips_path, "copy" if self.link_mode == "copy" else "reflink")
+            self.manifest.record(zips_path)
+        return saved
+
+    def _cache_key(self, folder, addon_id, version):
         """
-        Generates a zip for each found addon, and updates the addons.xml file accordingly.
+        Returns a hash over the addon version and the content of every file that ends up
+        in the zip or the meta files of the addon. With from_git the blob ids stand in for
+        the content.
         """
-        if not os.path.exists(addons_xml_path):
-            addons_root = ElementTree.Element('addons')
-            addons_xml = ElementTree.ElementTree(addons_root)
-        else:
-            addons_xml = ElementTree.parse(addons_xml_path)
-            addons_root = addons_xml.getroot()
-
-        folders = [
-            i
-            for i in os.listdir(self.addon_path)
-            if os.path.isdir(os.path.join(self.addon_path, i))
-            and i != "zips"
-            and not i.startswith(".")
-            and os.path.exists(os.path.join(self.addon_path, i, "addon.xml"))
+        key = hashlib.sha256(
+            f"{CACHE_VERSION}\0{self.compression}\0{self.compress_level}\0{addon_id}\0{version}\0".encode()
+        )
+        if self.optimise_images:
+            key.update(b"optimise-images\0")
+        addon_folder = os.path.join(self.addon_path, folder)
+        files = self._zip_files(folder, addon_id, verbose=False)
+        files += [
+            (os.path.join(addon_folder, file), os.path.join("meta", file))
+            for file in self._meta_files(folder)
         ]
+        manifest = self._source_manifest(folder)
+        file_hashes = self._file_hashes[folder] = {}
+        for file_path, name in files:
+            if not manifest.isfile(file_path):
+                continue
+            if self.from_git:
+                blob = self._git_tree(folder).blobs[file_path]
+                file_hashes[file_path] = "git-" + blob
+                key.update(f"{name}\0{blob}\0".encode())
+                continue
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            # Also identifies the file in the member cache, see _member_key()
+            file_hashes[file_path] = digest.hexdigest()
+            key.update(f"{name}\0{digest.hexdigest()}\0".encode())
+        return key.hexdigest()
+
+    def _placed_keys(self, addon_id):
+        # Zip folder -> cache key of the build of the addon last placed in it
+        try:
+            with open(os.path.join(self.cache_path, addon_id, "placed")) as f:
+                return dict(line.rsplit(" ", 1) for line in f.read().splitlines())
+        except (OSError, ValueError):
+            return {}
 
-        addon_xpath = "addon[@id='{}']"
-        changed = False
-        for addon in folders:
+    def _restore_cached(self, addon_id, key, zip_folder, built=False, placed=False):
+        """
+        Copies a cached build of an addon into its folder of a target tree, skipping files
+        that are already in place: of the same size, and with the same mtime unless placed,
+        i.e. this build was already placed there. The mtime of a published copy may have
+        been restored to that of an earlier build, see restore_published_mtimes().
+        """
+        cache_folder = os.path.join(self.cache_path, addon_id, key)
+        copied = 0
+        for root, dirs, files in os.walk(cache_folder):
+            for file in files:
+                src = os.path.join(root, file)
+                dst = os.path.join(zip_folder, os.path.relpath(src, cache_folder))
+                stats = os.stat(src)
+                entry = self.manifest.get(dst)
+                if entry is not None and entry.size == stats.st_size and (placed or entry.mtime == stats.st_mtime):
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                _place_file(src, dst, self.link_mode)
+                self.manifest.record(dst)
+                copied += 1
+        if copied:
+            msg = "Successfully updated {}" if built else "Reused cached build of {}"
+            print(msg.format(color_text(zip_folder, 'yellow')))
+
+    def _prune_zip_folder(self, addon_id, key, zip_folder):
+        """
+        Removes files of older builds from the zip folder of an addon, i.e. everything that
+        is not part of the cached build, except the index files.
+        """
+        cache_folder = os.path.join(self.cache_path, addon_id, key)
+        for root, dirs, files in reversed(list(self.manifest.walk(zip_folder))):
+            cache_root = os.path.join(cache_folder, os.path.relpath(root, zip_folder))
+            if not os.path.isdir(cache_root):
+                shutil.rmtree(root)
+                self.manifest.remove(root)
+                print("Removed stale folder: {}".format(color_text(root, 'red')))
+                continue
+            for file in files:
+                if file not in INDEX_FILES and not os.path.exists(os.path.join(cache_root, file)):
+                    path = os.path.join(root, file)
+                    os.remove(path)
+                    self.manifest.remove(path)
+                    print("Removed stale file: {}".format(color_text(path, 'red')))
+
+    def _build_cached(self, folder, addon_id, version, key):
+        """
+        Packages an addon into the build cache, replacing older builds of the same addon.
+        The build is staged in a temporary folder so an interrupted build is never reused.
+        """
+        addon_cache = os.path.join(self.cache_path, addon_id)
+        cache_folder = os.path.join(addon_cache, key)
+        tmp_folder = cache_folder + ".tmp"
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        os.makedirs(tmp_folder)
+
+        saved = self.build_zip(folder, addon_id, version, zip_folder=tmp_folder)
+        saved += self._copy_meta_files(folder, tmp_folder)
+        if self.optimise_images:
+            print("- {} bytes saved by optimising images".format(saved))
+
+        for old in os.listdir(addon_cache):
+            if old not in (os.path.basename(tmp_folder), "members", "images", "placed"):
+                shutil.rmtree(os.path.join(addon_cache, old))
+        os.rename(tmp_folder, cache_folder)
+        # The image cache entries this build used, which a full build keeps, see _prune_image_cache()
+        with _cache_writer(os.path.join(addon_cache, "images")) as f:
+            f.write("".join(digest + "\n" for digest in sorted(self._image_digests.pop(folder, ()))).encode())
+
+    def _package_addon(self, folder, addon_id, version, targets, manifest=None):
+        """
+        Creates the zip file and copies the meta files of a single addon into the build
+        cache, unless they are cached already (and not force), and syncs them into the tree
+        of each target.
+        Runs in a worker process when packaging in parallel, in which case the addon's part
+        of the manifest is passed in and returned updated.
+        """
+        if manifest is not None:
+            self.manifest = manifest
+
+        with PROFILER.span(addon_id, "addon", version=version) as span:
             try:
-                addon_xml_path = os.path.join(self.addon_path, addon, "addon.xml")
-                addon_xml = ElementTree.parse(addon_xml_path)
-                addon_root = addon_xml.getroot()
-                id = addon_root.get('id')
-                version = addon_root.get('version')
-
-                updated = False
-                addon_entry = addons_root.find(addon_xpath.format(id))
-                if addon_entry is not None and addon_entry.get('version') != version:
-                    index = addons_root.findall('addon').index(addon_entry)
-                    addons_root.remove(addon_entry)
-                    addons_root.insert(index, addon_root)
-                    updated = True
-                    changed = True
-                elif addon_entry is None:
-                    addons_root.append(addon_root)
-                    updated = True
-                    changed = True
-
-                if updated:
-                    # Create the zip files
-                    self.build_zip(addon, id, version)
-                    # Copy meta files
-                    self._copy_meta_files(addon, os.path.join(self.zips_path, id))
-            except Exception as e:
+                key = self._cache_key(folder, addon_id, version)
+                built = self.force or not os.path.isdir(os.path.join(self.cache_path, addon_id, key))
+                if span is not None:
+                    span["cached"] = not built
+                if built:
+                    self._build_cached(folder, addon_id, version, key)
+            finally:
+                self._file_hashes.pop(folder, None)
+                self._image_digests.pop(folder, None)
+                if folder in self._git_trees:
+                    self._git_trees.pop(folder).close()
+            placed = self._placed_keys(addon_id)
+            for target in targets:
+                zip_folder = os.path.join(self._target_path(target), addon_id)
+                self._restore_cached(addon_id, key, zip_folder, built=built, placed=placed.get(zip_folder) == key)
+                self._prune_zip_folder(addon_id, key, zip_folder)
+                placed[zip_folder] = key
+            with _cache_writer(os.path.join(self.cache_path, addon_id, "placed")) as f:
+                f.write("".join("{} {}\n".format(*item) for item in sorted(placed.items())).encode())
+        return self.manifest
+
+    def _package_addon_job(self, folder, addon_id, version, targets, manifest, metadata, profile=False):
+        """
+        Runs _package_addon() in a worker process and returns the updated manifest (None if
+        it failed), the spans profiled in the worker, what it printed and the exception it
+        raised if any. The output is printed by the process that submitted the job, so the
+        output of the workers doesn't interleave.
+        """
+        PROFILER.reset(enabled=profile)
+        self.addons = {folder: metadata}
+        output = io.StringIO()
+        try:
+            with redirect_stdout(output):
+                manifest = self._package_addon(folder, addon_id, version, targets, manifest)
+        except Exception as e:
+            return None, PROFILER.spans, output.getvalue(), e
+        return manifest, PROFILER.spans, output.getvalue(), None
+
+    def _package_addons(self, packages, executor=None):
+        """
+        Packages the addons, in the worker processes of executor if given. The results are
+        collected in submission order so the output stays deterministic.
+        """
+        if executor is not None:
+            results = self._submit_packages(executor, packages)
+        else:
+            results = []
+            for addon, id, version, targets in packages:
+                try:
+                    self._package_addon(addon, id, version, targets)
+                    results.append((id, None))
+                except Exception as e:
+                    results.append((id, e))
+
+        for id, e in results:
+            if e is not None:
                 print(
                     "Excluding {}: {}".format(
                         color_text(id, 'yellow'), color_text(e, 'red')
                     )
                 )
 
-        if changed:
-            addons_root[:] = sorted(addons_root, key=lambda addon: addon.get('id'))
-            try:
-                addons_xml.write(
-                    addons_xml_path, encoding="utf-8", xml_declaration=True
+    def _submit_packages(self, executor, packages):
+        # Packages the addons in the worker processes of executor and merges their manifests
+        futures = [
+            (
+                id,
+                executor.submit(
+                    self._package_addon_job, addon, id, version, targets,
+                    self.manifest.subset(
+                        os.path.join(self.addon_path, addon),
+                        *[os.path.join(self._target_path(target), id) for target in targets],
+                    ),
+                    self.addons[addon],
+                    PROFILER.enabled,
+                ),
+            )
+            for addon, id, version, targets in packages
+        ]
+        results = []
+        for id, future in futures:
+            e = future.exception()
+            if e is None:
+                manifest, spans, output, e = future.result()
+                sys.stdout.write(output)
+                PROFILER.spans.extend(spans)
+                if e is None:
+                    self.manifest.update(manifest)
+            results.append((id, e))
+        return results
+
+    def zip_folders(self, folder):
+        """
+        Returns the zip folders of an addon folder in the target trees it is built for.
+        """
+        metadata = self.addons.get(folder)
+        if metadata is None:
+            return []
+        return [
+            os.path.join(self._target_path(target), metadata.id)
+            for target in _addon_targets(metadata.python, self.targets)
+        ]
+
+    def schedule(self, scheduler, deps=(), rescan=(), folder_deps=None, only=None):
+        """
+        Adds the build to a scheduler: a task per addon folder that packages the addon after
+        deps and the tasks in folder_deps[folder] (e.g. the update of its submodule), and a
+        task that updates the addons.xml of each target once every addon is packaged. The
+        folders in rescan are scanned again by their task first. Returns the names of the
+        addon tasks by folder, and that of the addons.xml task.
+
+        Up to jobs addons are packaged at a time, in worker processes when jobs > 1. With
+        the same id and version in more than one folder only the first one scanned is built.
+
+        With only, just those addon folders are packaged; the addons.xml entries of the
+        others are kept as they are.
+        """
+        folder_deps = folder_deps or {}
+        state = {}
+        if only is None:
+            # The build trees may not be scanned yet, see scan_trees()
+            folders = [
+                folder for folder in sorted(os.listdir(self.addon_path))
+                if folder != "zips" and not folder.startswith(".")
+                and os.path.isdir(os.path.join(self.addon_path, folder))
+            ]
+        else:
+            folders = sorted(only)
+
+        def prepare():
+            self._make_target_paths()
+            state["existing"] = self._existing_versions()
+            if only is None:
+                state["dropped_ids"] = set()
+                self.addons.clear()
+            else:
+                # The ids of the rebuilt folders are dropped unless they are still there
+                state["dropped_ids"] = {self.addons.pop(folder).id for folder in only if folder in self.addons}
+            if self.jobs > 1 and len(folders) > 1:
+                # Forked workers would inherit the state of the other tasks' threads, e.g. the
+                # pipe of a git process being started, which then never sees its exec finish
+                methods = multiprocessing.get_all_start_methods()
+                state["executor"] = ProcessPoolExecutor(
+                    max_workers=self.jobs,
+                    mp_context=multiprocessing.get_context("forkserver" if "forkserver" in methods else None),
                 )
+            self._scanned = {}
+
+        def write_addons_files():
+            if "executor" in state:
+                state.pop("executor").shutdown()
+            self._write_addons_files(state["existing"], only, state["dropped_ids"])
+
+        prepare_task = scheduler.add("prepare", prepare, deps=deps, category="package")
+        tasks = {}
+        for folder in folders:
+            tasks[folder] = scheduler.add(
+                "addon " + folder, self._build_addon, folder, folder in rescan, state,
+                deps=[prepare_task, *folder_deps.get(folder, ())], category="package", group="package",
+            )
+        scheduler.limits.setdefault("package", self.jobs)
+        addons_xml_task = scheduler.add("addons.xml", write_addons_files, deps=list(tasks.values()), category="phase")
+        return tasks, addons_xml_task
+
+    def _build(self, **kwargs):
+        # Runs the build (see schedule()) on a scheduler of its own
+        scheduler = Scheduler(workers=self.jobs + 4)
+        self.schedule(scheduler, **kwargs)
+        scheduler.run()
+
+    def _build_addon(self, folder, rescan, state):
+        # A task of schedule(): packages the addon in folder, if it is one
+        path = os.path.join(self.addon_path, folder)
+        if rescan:
+            self.manifest.remove(path)
+            self.manifest.scan(path)
+        if not self.manifest.isfile(os.path.join(path, "addon.xml")):
+            return
+        self._remove_binaries(folder)
+        package = self._scan_addon(folder, state["existing"])
+        if package is not None:
+            self._package_addons([package], state.get("executor"))
 
-                return changed
-            except Exception as e:
+    def update_addons(self, folders):
+        """
+        Rebuilds only the given addon folders, e.g. after they changed in watch mode: their
+        zips and meta files, their entries in the addons.xml of each target and the checksum
+        files. Returns the zip folders that may have changed, for generate_indices().
+        """
+        previous_ids = {self.addons[folder].id for folder in folders if folder in self.addons}
+        self._build(rescan=folders, only=folders)
+        ids = previous_ids | {self.addons[folder].id for folder in folders if folder in self.addons}
+        return [os.path.join(self._target_path(target), id) for target in self.targets for id in sorted(ids)]
+
+    def _existing_versions(self):
+        # The addon versions in the addons.xml of each target, and whether it is sorted
+        return {
+            target: _read_addon_versions(os.path.join(self._target_path(target), "addons.xml"))
+            for target in self.targets
+        }
+
+    def _scan_addon(self, folder, existing):
+        """
+        Reads the metadata of an addon folder for the current build and reports the addon
+        if it is new or updated in a target. Returns what _package_addons() needs to
+        package it, or None if it is excluded or another folder has the same id and version.
+        """
+        try:
+            metadata = self._addon_metadata(folder)
+            id = metadata.id
+            version = metadata.version
+
+            with self._lock:
+                if (id, version) in self._scanned:
+                    return None
+                targets = _addon_targets(metadata.python, self.targets)
+                self._scanned[id, version] = (folder, metadata, targets)
+                self.addons[folder] = metadata
+        except Exception as e:
+            print(
+                "Excluding {}: {}".format(
+                    color_text(folder, 'yellow'), color_text(e, 'red')
+                )
+            )
+            return None
+
+        for target in targets:
+            existing_versions = existing[target][0]
+            suffix = "" if target == "repo" else " ({})".format(target)
+            if id not in existing_versions:
+                print("New addon: {} {}{}".format(color_text(id, 'green'), version, suffix))
+            elif existing_versions[id] != version:
+                print("Updated addon: {} {} -> {}{}".format(
+                    color_text(id, 'green'), existing_versions[id], version, suffix
+                ))
+        return folder, id, version, targets
+
+    def _write_addons_files(self, existing, only=None, dropped_ids=()):
+        """
+        Updates the addons.xml file (and its checksum files) of each target with the addons
+        scanned for the current build, and removes the folders of addons that no longer
+        exist. With only, the entries of the other addons are kept as they are.
+        """
+        new_entries = {}
+        addon_targets = {}
+        for folder, metadata, targets in sorted(self._scanned.values(), key=lambda scanned: scanned[0]):
+            new_entries[metadata.id] = metadata
+            addon_targets[metadata.id] = targets
+        self._scanned = {}
+
+        self.metadata_cache.save(prune=only is None)
+        if only is None:
+            self._prune_image_cache(new_entries)
+        if self.gzip is None:
+            self.gzip = self._repository_compressed()
+
+        for target in self.targets:
+            target_path = self._target_path(target)
+            target_entries = {id: metadata for id, metadata in new_entries.items() if target in addon_targets[id]}
+            keep_ids = set(target_entries)
+            if only is not None:
+                keep_ids |= set(existing[target][0]) - dropped_ids
+            self._remove_stale_addons(keep_ids, target_path)
+            addons_xml_path = os.path.join(target_path, "addons.xml")
+            with PROFILER.span(addons_xml_path, "addons.xml"):
+                updated = self._generate_addons_file(addons_xml_path, target_entries, *existing[target], keep_ids)
+            if updated:
                 print(
-                    "An error occurred updating {}!\n{}".format(
-                        color_text(addons_xml_path, 'yellow'), color_text(e, 'red')
-                    )
+                    "Successfully updated {}".format(color_text(addons_xml_path, 'yellow'))
                 )
 
-    def _generate_md5_file(self, file_path, md5_path):
+                for checksum_path in self._generate_checksum_files(addons_xml_path):
+                    print("Successfully updated {}".format(color_text(checksum_path, 'yellow')))
+            if not self.gzip:
+                self._remove_gzip_files(addons_xml_path)
+
+    def _remove_gzip_files(self, addons_xml_path):
+        """
+        Removes the addons.xml.gz (and its checksum files) of an earlier build written with
+        gzip, which would otherwise keep being published with outdated entries.
         """
-        Generates a new addons.xml.md5 file.
+        gz_path = addons_xml_path + ".gz"
+        for path in [gz_path, gz_path + ".md5", gz_path + ".sha256"]:
+            if self.manifest.isfile(path):
+                os.remove(path)
+                self.manifest.remove(path)
+                print("Removed stale file: {}".format(color_text(path, 'red')))
+
+    def _generate_addons_file(self, addons_xml_path, new_entries, existing_versions, existing_sorted, keep_ids):
         """
+        Updates an addons.xml file with the entries of the addons packaged for it, dropping
+        the entries of addons that are not in keep_ids. addons.xml is left untouched if its
+        content did not change.
+        """
+        # Staged outside of zips/ so the folder (and its mtime) is only touched on changes
+        os.makedirs(self.cache_path, exist_ok=True)
+        tmp_path = os.path.join(self.cache_path, os.path.basename(addons_xml_path) + ".tmp")
         try:
-            m = hashlib.md5(open(file_path, "rb").read()).hexdigest()
-            _save_file(m, file=md5_path)
+            with ExitStack() as stack:
+                self.addons_xml_hashes = _HashingWriter(stack.enter_context(open(tmp_path, "wb")))
+                out = self.addons_xml_hashes
+                if self.gzip:
+                    # Written in the same pass; no file name and a fixed mtime keep the header deterministic
+                    gz_file = stack.enter_context(open(tmp_path + ".gz", "wb"))
+                    self.addons_xml_gz_hashes = _HashingWriter(gz_file)
+                    gz = stack.enter_context(
+                        gzip.GzipFile(filename="", mode="wb", fileobj=self.addons_xml_gz_hashes, mtime=0)
+                    )
+                    out = _TeeWriter(out, gz)
+
+                existing = _iter_addon_entries(addons_xml_path)
+                if not existing_sorted:
+                    existing = sorted(existing, key=lambda addon: addon.get('id'))
+                _write_addons_xml(
+                    out, _merge_addon_entries(existing, new_entries, existing_versions, keep_ids=keep_ids)
+                )
 
+            if self._unchanged(addons_xml_path, self.addons_xml_hashes) and (
+                not self.gzip or self.manifest.isfile(addons_xml_path + ".gz")
+            ):
+                os.remove(tmp_path)
+                if self.gzip:
+                    os.remove(tmp_path + ".gz")
+                print("No changes to {}".format(color_text(addons_xml_path, 'yellow')))
+                return False
+
+            os.replace(tmp_path, addons_xml_path)
+            self.manifest.record(addons_xml_path)
+            if self.gzip:
+                os.replace(tmp_path + ".gz", addons_xml_path + ".gz")
+                self.manifest.record(addons_xml_path + ".gz")
             return True
         except Exception as e:
             print(
                 "An error occurred updating {}!\n{}".format(
-                    color_text(md5_path, 'yellow'), color_text(e, 'red')
+                    color_text(addons_xml_path, 'yellow'), color_text(e, 'red')
                 )
             )
 
-if __name__ == "__main__":
-    # Check if there are committed/uncommitted or untracked changes in submodule(s)
-    check_submodules()
+    def _unchanged(self, file_path, hashes):
+        """
+        Returns True if file_path exists with a .sha256 checksum file that matches the hashes.
+        """
+        sha256_path = file_path + ".sha256"
+        if not self.manifest.isfile(file_path) or not self.manifest.isfile(sha256_path):
+            return False
+        with open(sha256_path) as f:
+            return f.read().strip() == hashes.sha256.hexdigest()
+
+    def _remove_stale_addons(self, addon_ids, target_path):
+        """
+        Removes the folders of addons that are no longer in the repository, or no longer
+        built for the target, and the trees of targets that are no longer built.
+        """
+        for name in self.manifest.listdir(target_path):
+            path = os.path.join(target_path, name)
+            if self.manifest.isdir(path) and name not in addon_ids and name not in self.targets:
+                shutil.rmtree(path)
+                self.manifest.remove(path)
+                print("Removed stale folder: {}".format(color_text(path, 'red')))
+
+    def _generate_checksum_files(self, file_path):
+        """
+        Generates new addons.xml.md5 and addons.xml.sha256 files (and the same for
+        addons.xml.gz) from the digests computed while addons.xml was written.
+        """
+        try:
+            checksum_paths = _save_checksums(self.addons_xml_hashes, file_path)
+            if self.addons_xml_gz_hashes is not None:
+                print("Successfully updated {}".format(color_text(file_path + ".gz", 'yellow')))
+                checksum_paths += _save_checksums(self.addons_xml_gz_hashes, file_path + ".gz")
+            for checksum_path in checksum_paths:
+                self.manifest.record(checksum_path)
+            return checksum_paths
+        except Exception as e:
+            print(
+                "An error occurred updating the checksums of {}!\n{}".format(
+                    color_text(file_path, 'yellow'), color_text(e, 'red')
+                )
+            )
+            return []
+
+class _InotifyWatcher:
+    """
+    Watches a folder and everything below it with inotify (Linux only), through ctypes.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200 | 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+
+        self.path = path
+        library = ctypes.util.find_library("c")
+        if library is None:
+            raise OSError("libc was not found")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify is not available")
+        self.watches = {}  # watch descriptor -> folder
+        self._watch_tree(path)
+
+    def _watch_tree(self, path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not _watch_ignored(d)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.MASK)
+            if wd >= 0:
+                self.watches[wd] = root
+
+    def wait(self, timeout=None):
+        """
+        Returns the paths that changed, waiting up to timeout seconds (forever with None)
+        for the first change. Returns an empty list if nothing changed.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost: treat everything as changed
+                changed.append(self.path)
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], os.fsdecode(name)) if name else self.watches[wd]
+            if mask & self.IN_ISDIR and mask & (0x080 | 0x100) and not _watch_ignored(os.path.basename(path)):
+                # A new folder (or one moved in), with files that may already be in it
+                self._watch_tree(path)
+            changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingWatcher:
+    """
+    Watches a folder and everything below it by comparing the sizes and mtimes of its
+    files every WATCH_POLL_INTERVAL seconds, where inotify is not available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if not _watch_ignored(d)]
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stats.st_size, stats.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Returns the paths that changed, waiting up to timeout seconds (forever with None)
+        for the first change. Returns an empty list if nothing changed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = WATCH_POLL_INTERVAL if deadline is None else min(WATCH_POLL_INTERVAL, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+            snapshot = self._scan()
+            changed = [
+                path for path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(path) != self.snapshot.get(path)
+            ]
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
 
-    # Clean up old zips & other artifacts
-    cleanup()
+    def close(self):
+        pass
 
-    # Generate repository & addon zip files
-    Generator()
+
+def _watch_ignored(name):
+    # Files and folders that never end up in a zip and change on their own (git, editors, Python)
+    return name.startswith(".") or name == "__pycache__" or name.endswith((".pyc", ".pyo", "~"))
+
+
+def schedule_build(scheduler, generator, outdated=(), jobs=1, force=False, link_mode="auto"):
+    """
+    Adds the phases of a build to a scheduler: the update of the outdated submodules,
+    cleanup, a scan of the build trees into the (empty) manifest of the generator, the
+    addons (see Generator.schedule()), the repository zip in the root folder, the index
+    pages and the published manifest.
+    """
+    manifest = generator.manifest
+    published = _load_published_manifest()
+
+    # Addon folders in a submodule that is updated wait for the update (and are scanned after it)
+    updating = {}
+    if outdated:
+        scheduler.add("update_submodules", update_submodules, outdated, jobs, category="phase")
+        updating = {
+            folder: ["update_submodules"]
+            for folder in os.listdir(generator.addon_path)
+            if any(_is_related_path(os.path.join(generator.addon_path, folder), path) for path in outdated)
+        }
+
+    # Clean up old artifacts (and all zips when forced)
+    scheduler.add("cleanup", cleanup, force, category="phase")
+
+    # Scan the build trees once; every later task reads and updates this manifest
+    scheduler.add("scan", scan_trees, manifest, updating, deps=["cleanup"], category="phase")
+
+    # Generate repository & addon zip files, and the addons.xml once all addons are packaged
+    addon_tasks, addons_xml_task = generator.schedule(
+        scheduler, deps=["scan"], rescan=updating, folder_deps=updating
+    )
 
     # Copy repository zip file to root folder
-    copy_repo_zip()
+    scheduler.add(
+        "copy_repo_zip", copy_repo_zip, manifest, link_mode,
+        deps=[addon_tasks.get("repository.verkurkie", addons_xml_task)], category="phase",
+    )
+
+    # Index the zip folders of each addon as soon as it is packaged. Keeps the mtime of files
+    # that were written again with the same content first, e.g. after --force. The repository
+    # zip may be a hard link to the one in the root folder, so that one is copied first.
+    indexed = {}
+    index_tasks = [
+        scheduler.add(
+            "index " + folder, index_zip_folders, manifest, published, generator, folder, indexed,
+            deps=[task, "copy_repo_zip"] if folder == "repository.verkurkie" else [task], category="index",
+        )
+        for folder, task in addon_tasks.items()
+    ]
+
+    # Generate the remaining indices, the zips folders above the addons and the root
+    def finish_indices():
+        restore_published_mtimes(manifest, published, skip=indexed)
+        generate_indices(manifest, addons=generator.addons, done=indexed)
+
+    scheduler.add(
+        "generate_indices", finish_indices, deps=[addons_xml_task, "copy_repo_zip", *index_tasks], category="phase"
+    )
+
+    # Record the published files and what changed since the previous build
+    def publish():
+        restore_published_mtimes(manifest, published, indices=True)
+        write_published_manifest(manifest, published)
+
+    scheduler.add("write_published_manifest", publish, deps=["generate_indices"], category="phase")
+
+
+def watch(generator, link_mode="auto"):
+    """
+    Watches the addon sources after a build and rebuilds only the addons that changed:
+    their zips, meta files, addons.xml entries, checksums and the affected index pages.
+    Changes are collected until none came in for WATCH_DEBOUNCE seconds. Runs until
+    interrupted with Ctrl+C.
+    """
+    manifest = generator.manifest
+    watcher = None
+    if sys.platform.startswith("linux"):
+        try:
+            watcher = _InotifyWatcher(generator.addon_path)
+        except (OSError, AttributeError):
+            pass
+    if watcher is None:
+        watcher = _PollingWatcher(generator.addon_path)
+    print("Watching {} for changes, press Ctrl+C to stop...".format(color_text(generator.addon_path, 'yellow')))
+
+    try:
+        while True:
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed += more
+
+            folders = set()
+            for path in changed:
+                parts = os.path.relpath(path, generator.addon_path).split(os.sep)
+                if parts[0] in (".", "..") or any(_watch_ignored(part) for part in parts):
+                    continue
+                folders.add(parts[0])
+            if not folders:
+                continue
+
+            start = time.perf_counter()
+            print("Changed: {}".format(", ".join(color_text(folder, 'green') for folder in sorted(folders))))
+            zip_folders = generator.update_addons(sorted(folders))
+            if any(
+                folder in generator.addons and generator.addons[folder].id == "repository.verkurkie"
+                for folder in folders
+            ):
+                cleanup()
+                copy_repo_zip(manifest, link_mode=link_mode)
+            generate_indices(manifest, folders=zip_folders, addons=generator.addons)
+            print("Rebuilt in {:.3f}s".format(time.perf_counter() - start))
+    except KeyboardInterrupt:
+        print(color_text("\nStopped watching.", "yellow"))
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the addon zips, addons.xml and index pages of the repository.")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of worker processes used to package addons (0 = one per CPU core, default: 1)",
+    )
+    parser.add_argument(
+        "--zip-threads", type=int, default=0,
+        help="threads that compress the members of a zip (default: 0, the CPU cores left per job)",
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="remove the zips folder, ignore the build cache and package every addon again",
+    )
+    parser.add_argument(
+        "--compression", choices=COMPRESSION_POLICIES, default="auto",
+        help="which zip members to deflate: auto (skip known and probed incompressible files), "
+        "extension (skip known incompressible extensions) or deflate (everything); default: auto",
+    )
+    parser.add_argument(
+        "--compress-level", type=int, choices=range(0, 10), metavar="0-9",
+        help="deflate compression level (default: zlib default)",
+    )
+    parser.add_argument(
+        "--optimise-images", action="store_true",
+        help="losslessly optimise the PNG and JPEG images in the zips and meta files (cached in .build-cache/images)",
+    )
+    parser.add_argument(
+        "--gzip", action=argparse.BooleanOptionalAction, default=None,
+        help="also write addons.xml.gz (default: follow the compressed attribute in the repository addon.xml)",
+    )
+    parser.add_argument(
+        "--targets", nargs="+", choices=KODI_VERSIONS, default=["repo"],
+        help="Kodi versions to also build a tree with its own addons.xml for, in zips/<version>/; "
+        "the repo target (the zips folder itself, every addon) is always built",
+    )
+    parser.add_argument(
+        "--profile", nargs="?", const="build-trace.json", metavar="TRACE",
+        help="record the time and I/O of each phase, addon and zip member, and the process's "
+        "peak memory so far, write them as a Chrome trace (default: build-trace.json) and print "
+        "the slowest ones",
+    )
+    parser.add_argument(
+        "--from-git", action="store_true",
+        help="package the files committed in each addon folder or submodule (HEAD) instead of the work tree",
+    )
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="after the build, keep watching repo/ and rebuild the addons that change",
+    )
+    parser.add_argument(
+        "--link", choices=LINK_MODES, default="auto",
+        help="how built files are placed into zips/: auto (reflink, else hard link, else copy), "
+        "reflink, hardlink or copy; default: auto",
+    )
+    args = parser.parse_args()
+    PROFILER.reset(enabled=args.profile is not None)
+
+    # Check if there are committed/uncommitted or untracked changes in submodule(s); the ones
+    # that are not at their recorded commit are updated while the build goes on
+    with PROFILER.span("check_submodules", "phase"):
+        outdated = check_submodules(jobs=args.jobs, update=False)
+
+    # The phases and addons of the build are tasks that run as soon as what they depend on is done
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    scheduler = Scheduler(workers=jobs + 4)
+    generator = Generator(
+        jobs=args.jobs,
+        force=args.force,
+        compression=args.compression,
+        compress_level=args.compress_level,
+        gzip=args.gzip,
+        manifest=Manifest(),
+        link_mode=args.link,
+        targets=args.targets,
+        from_git=args.from_git,
+        zip_threads=args.zip_threads,
+        optimise_images=args.optimise_images,
+        build=False,
+    )
+    schedule_build(scheduler, generator, outdated, args.jobs, force=args.force, link_mode=args.link)
+    scheduler.run()
+
+    if args.profile is not None:
+        PROFILER.write_trace(args.profile)
+        PROFILER.print_summary()
+        print("Trace written to {}".format(color_text(args.profile, 'yellow')))
 
-    # Generate indices
-    generate_indices()
+    if args.watch:
+        watch(generator, link_mode=args.link)
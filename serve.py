@@ -0,0 +1,452 @@
+"""
+    Serves the generated repository (the root index and repository zip, and zips/) locally,
+    and simulates Kodi clients polling it. Run from the root of the repo after a build, e.g.:
+
+        python3 serve.py serve --port 8000
+        python3 serve.py load --clients 2000 --duration 10
+        python3 serve.py load --url http://127.0.0.1:8000 --conditional
+
+    Load results are printed as JSON so they can be compared between commits.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import mimetypes
+import http.client
+import email.utils
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+from xml.etree import ElementTree
+
+import build
+
+CHUNK_SIZE = 256 * 1024
+# Compressed files requested as such are served as-is, like SimpleHTTPRequestHandler does, not
+# as the type of their content (which mimetypes guesses) without a Content-Encoding
+COMPRESSED_TYPES = {
+    ".gz": "application/gzip",
+    ".Z": "application/octet-stream",
+    ".bz2": "application/x-bzip2",
+    ".xz": "application/x-xz",
+}
+
+
+class Metadata:
+    """
+    ETags and dates of the published files. A file's ETag is the SHA-256 that the build
+    recorded in its published manifest, as long as the file's size and mtime still match
+    (e.g. not after a rebuild in watch mode); otherwise it is made from the size and mtime.
+    The manifest is loaded again when a build replaced it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, build.PUBLISHED_MANIFEST)
+        self.manifest_mtime = None
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.manifest_mtime:
+            return
+        with self.lock:
+            try:
+                with open(self.manifest_path) as f:
+                    self.files = json.load(f)["files"]
+            except (OSError, ValueError, KeyError):
+                self.files = {}
+            self.manifest_mtime = mtime
+
+    def lookup(self, path):
+        """
+        Returns (file path, size, mtime in seconds, ETag) of a published file, given its path
+        relative to the root with forward slashes, or None if it is not published.
+        """
+        top = path.split("/", 1)[0]
+        if not (top == "zips" or (top == path and (path in build.INDEX_FILES or path.endswith(".zip")))):
+            return None
+        file_path = os.path.join(self.root, *path.split("/"))
+        try:
+            stats = os.stat(file_path)
+        except OSError:
+            return None
+        if not os.path.isfile(file_path):
+            return None
+
+        self._reload()
+        entry = self.files.get(path)
+        if entry is not None and (entry["size"], entry["mtime_ns"]) == (stats.st_size, stats.st_mtime_ns):
+            etag = '"{}"'.format(entry["sha256"])
+        else:
+            etag = '"{:x}-{:x}"'.format(stats.st_size, stats.st_mtime_ns)
+        return file_path, stats.st_size, stats.st_mtime, etag
+
+
+class RepositoryHandler(BaseHTTPRequestHandler):
+    """
+    Serves published files with ETag/Last-Modified conditional requests, single byte
+    ranges (with If-Range), and the prebuilt .gz variant of a file (e.g. addons.xml.gz)
+    to clients that accept gzip. Folders are served by their index.html.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, every response has a Content-Length
+    # Headers and body are separate writes; with Nagle on, small responses wait for delayed ACKs
+    disable_nagle_algorithm = True
+    server_version = "verkurkie-repository"
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _serve(self, head):
+        path = unquote(urlsplit(self.path).path).lstrip("/")
+        parts = path.split("/")
+        if any(part in ("..", ".") for part in parts) or "\\" in path:
+            self._send_empty(HTTPStatus.NOT_FOUND)
+            return
+        if path == "" or path.endswith("/"):
+            path += "index.html"
+        elif os.path.isdir(os.path.join(self.server.root, *parts)):
+            self._send_empty(HTTPStatus.MOVED_PERMANENTLY, {"Location": "/" + path + "/"})
+            return
+
+        info = self.server.metadata.lookup(path)
+        if info is None:
+            self._send_empty(HTTPStatus.NOT_FOUND)
+            return
+        headers = {}
+        content_type = (
+            COMPRESSED_TYPES.get(os.path.splitext(path)[1])
+            or mimetypes.guess_type(path)[0]
+            or "application/octet-stream"
+        )
+
+        # Prefer the prebuilt gzip variant when the client accepts it
+        gzipped = self.server.metadata.lookup(path + ".gz")
+        if gzipped is not None:
+            headers["Vary"] = "Accept-Encoding"
+            if self._accepts_gzip():
+                info = gzipped
+                headers["Content-Encoding"] = "gzip"
+        file_path, size, mtime, etag = info
+        headers.update({
+            "Content-Type": content_type,
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+        })
+
+        if self._not_modified(etag, mtime):
+            self._send_empty(HTTPStatus.NOT_MODIFIED, headers)
+            return
+
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        byte_range = self._range(size, etag, mtime)
+        if byte_range is False:
+            headers["Content-Range"] = "bytes */{}".format(size)
+            self._send_empty(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers)
+            return
+        if byte_range is not None:
+            start, end = byte_range
+            status = HTTPStatus.PARTIAL_CONTENT
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+
+        length = end - start + 1
+        headers["Content-Length"] = str(length)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if head:
+            return
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(start)
+                while length > 0:
+                    chunk = f.read(min(CHUNK_SIZE, length))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    length -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            if name != "Content-Length":
+                self.send_header(name, value)
+        # A 304 has no body by definition; its Content-Length would be that of the file
+        if status != HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _accepts_gzip(self):
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+            if name.strip().lower() not in ("gzip", "*"):
+                continue
+            quality = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            return quality > 0
+        return False
+
+    def _not_modified(self, etag, mtime):
+        # If-None-Match wins over If-Modified-Since (RFC 9110, 13.2.2)
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def _range(self, size, etag, mtime):
+        """
+        Returns the (first, last) byte of a satisfiable single Range request, None to send
+        the whole file, or False if the range can't be satisfied.
+        """
+        header = self.headers.get("Range")
+        if header is None or not header.startswith("bytes=") or "," in header:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != etag and if_range != email.utils.formatdate(mtime, usegmt=True):
+            return None
+        first, _, last = header[len("bytes="):].strip().partition("-")
+        try:
+            if first == "":
+                # The last n bytes
+                n = int(last)
+                if n <= 0:
+                    return False
+                return max(0, size - n), size - 1
+            first = int(first)
+            last = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if first >= size or last < first:
+            return False
+        return first, min(last, size - 1)
+
+
+class RepositoryServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def __init__(self, address, root=".", verbose=False):
+        super().__init__(address, RepositoryHandler)
+        self.root = root
+        self.metadata = Metadata(root)
+        self.verbose = verbose
+
+
+def _zip_paths(addons_xml):
+    # The path of the zip of every addon listed in addons.xml
+    return [
+        "zips/{0}/{0}-{1}.zip".format(addon.get("id"), addon.get("version"))
+        for addon in ElementTree.fromstring(addons_xml).iter("addon")
+    ]
+
+
+class _Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, kind, status, latency, size):
+        self.latencies.setdefault(kind, []).append(latency)
+        statuses = self.statuses.setdefault(kind, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def merge(self, other):
+        for kind, latencies in other.latencies.items():
+            self.latencies.setdefault(kind, []).extend(latencies)
+        for kind, statuses in other.statuses.items():
+            merged = self.statuses.setdefault(kind, {})
+            for status, count in statuses.items():
+                merged[status] = merged.get(status, 0) + count
+        self.bytes += other.bytes
+        self.errors += other.errors
+
+
+def _percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run_load(url, clients=1000, duration=10.0, concurrency=32, download_ratio=0.05, conditional=False, seed=1):
+    """
+    Simulates clients Kodi installations that poll addons.xml.md5 at url, fetch addons.xml
+    (gzipped) when the checksum changed, and now and then download an addon zip. They take
+    turns on concurrency keep-alive connections for duration seconds. With conditional the
+    polls send If-None-Match, like a caching client would.
+    """
+    parsed = urlsplit(url)
+    base = parsed.path.rstrip("/")
+
+    # The zips that clients can download, from the served addons.xml
+    connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+    connection.request("GET", base + "/zips/addons.xml")
+    response = connection.getresponse()
+    zips = [base + "/" + path for path in _zip_paths(response.read())] if response.status == 200 else []
+    connection.close()
+
+    # Each client remembers the checksum (and ETag) it saw last
+    states = queue.SimpleQueue()
+    for _ in range(clients):
+        states.put({"md5": None, "etag": None})
+    stats = []
+    deadline = time.perf_counter() + duration
+
+    def worker(rnd):
+        local = _Stats()
+        stats.append(local)
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+
+        def get(kind, path, headers):
+            nonlocal connection
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                local.errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=30)
+                return None, None
+            local.add(kind, response.status, time.perf_counter() - start, len(body))
+            return response, body
+
+        while time.perf_counter() < deadline:
+            state = states.get()
+            headers = {"User-Agent": "Kodi/21.0 (load simulation)"}
+            if conditional and state["etag"]:
+                headers["If-None-Match"] = state["etag"]
+            response, body = get("poll", base + "/zips/addons.xml.md5", headers)
+            if response is not None and response.status == 200:
+                state["etag"] = response.getheader("ETag")
+                if body != state["md5"]:
+                    state["md5"] = body
+                    get("addons.xml", base + "/zips/addons.xml", {"Accept-Encoding": "gzip"})
+            if zips and rnd.random() < download_ratio:
+                get("zip", rnd.choice(zips), {})
+            states.put(state)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=worker, args=(random.Random(seed + i),)) for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = _Stats()
+    for local in stats:
+        total.merge(local)
+    requests = sum(len(latencies) for latencies in total.latencies.values())
+    result = {
+        "benchmark": "serve-load",
+        "clients": clients,
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "requests": requests,
+        "requests_per_s": requests / elapsed,
+        "bytes": total.bytes,
+        "mb_per_s": total.bytes / elapsed / (1024 * 1024),
+        "errors": total.errors,
+        "kinds": {},
+    }
+    for kind, latencies in sorted(total.latencies.items()):
+        latencies.sort()
+        result["kinds"][kind] = {
+            "requests": len(latencies),
+            "statuses": {str(status): count for status, count in sorted(total.statuses[kind].items())},
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p90_ms": _percentile(latencies, 90) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local server and load simulation for the built repository.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="serve the built repository")
+    serve_parser.add_argument("--bind", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    serve_parser.add_argument("-v", "--verbose", action="store_true", help="log every request")
+    load_parser = subparsers.add_parser("load", help="simulate Kodi clients polling the repository")
+    load_parser.add_argument(
+        "--url", help="repository to load, e.g. http://127.0.0.1:8000 (default: serve this folder on a free port)"
+    )
+    load_parser.add_argument("--clients", type=int, default=1000, help="number of simulated clients (default: 1000)")
+    load_parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (default: 10)")
+    load_parser.add_argument("--concurrency", type=int, default=32, help="open connections (default: 32)")
+    load_parser.add_argument(
+        "--download-ratio", type=float, default=0.05, help="share of polls followed by a zip download (default: 0.05)"
+    )
+    load_parser.add_argument("--conditional", action="store_true", help="poll with If-None-Match")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = RepositoryServer((args.bind, args.port), verbose=args.verbose)
+        print("Serving {} on http://{}:{}/ ...".format(os.path.abspath("."), *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        server = None
+        url = args.url
+        if url is None:
+            server = RepositoryServer(("127.0.0.1", 0))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = "http://127.0.0.1:{}".format(server.server_address[1])
+        try:
+            result = run_load(
+                url, args.clients, args.duration, args.concurrency, args.download_ratio, args.conditional
+            )
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+        json.dump(result, sys.stdout, indent=2)
+        print()